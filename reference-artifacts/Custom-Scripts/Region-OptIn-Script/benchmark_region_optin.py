@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for region_optin.py
+
+The Organizations and Account APIs are served by in-process fakes hooked into
+botocore's before-send event, so requests go through the real client
+serialization, signing and parsing code paths without any network access.
+
+Examples:
+    python3 benchmark_region_optin.py clients --accounts 2000
+    python3 benchmark_region_optin.py opt-in --accounts 100 1000 10000 --modes worker central
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# region_optin.py creates its clients at import time, make sure this never
+# reaches real credentials or endpoints
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['AWS_ACCESS_KEY_ID'] = 'benchmark'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'benchmark'
+os.environ.pop('AWS_PROFILE', None)
+os.environ.pop('AWS_SESSION_TOKEN', None)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import boto3  # noqa: E402
+from botocore.awsrequest import AWSResponse  # noqa: E402
+
+import region_optin  # noqa: E402
+
+BENCHMARK_REGION = 'ca-west-1'
+BENCHMARK_REGIONS = ['ca-west-1', 'il-central-1', 'me-central-1', 'ap-southeast-4',
+                     'eu-central-2', 'mx-central-1']
+MANAGEMENT_ACCOUNT_ID = '000000000000'
+ORGANIZATIONS_PAGE_SIZE = 20
+
+
+class FakeRawResponse:
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self, **kwargs):
+        yield self._body
+
+
+class FakeApiError(Exception):
+    def __init__(self, status_code, code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+class FakeApi:
+    """Base of the in-process API fakes: counts calls and builds botocore responses"""
+
+    def __init__(self, throttle_rate=0.0):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttle_rate = throttle_rate
+
+    def handle(self, request, **kwargs):
+        operation = self.operation(request)
+        params = json.loads(request.body or b'{}')
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            try:
+                if self.throttle_rate and random.random() < self.throttle_rate:
+                    raise FakeApiError(429, 'TooManyRequestsException', 'Rate exceeded')
+                status_code, body = 200, self.dispatch(operation, params)
+            except FakeApiError as e:
+                status_code = e.status_code
+                body = {'__type': e.code, 'message': str(e)}
+        headers = {'Content-Type': 'application/json'}
+        if status_code != 200:
+            headers['x-amzn-ErrorType'] = body['__type']
+        return AWSResponse(request.url, status_code, headers,
+                           FakeRawResponse(json.dumps(body).encode('utf-8')))
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+class FakeAccountApi(FakeApi):
+    """
+    In-process stand-in for the Account API
+    Every region starts DISABLED for every account. An enable/disable
+    transition takes a random time between latency_min and latency_max
+    seconds, and only one transition per account can be in progress.
+    """
+
+    def __init__(self, latency_min=0.0, latency_max=0.0, throttle_rate=0.0):
+        super().__init__(throttle_rate)
+        self.latency_min = latency_min
+        self.latency_max = latency_max
+        self.regions = {}
+
+    def register(self, session):
+        """Serve every Account API request of clients created from session"""
+        session.events.register('before-send.account', self.handle)
+
+    def operation(self, request):
+        return request.url.rsplit('/', 1)[-1]
+
+    def status(self, accountId, region):
+        status, ready_at = self.regions.get((accountId, region), ('DISABLED', None))
+        if ready_at is not None and time.monotonic() >= ready_at:
+            status = 'ENABLED' if status == 'ENABLING' else 'DISABLED'
+            self.regions[(accountId, region)] = (status, None)
+        return status
+
+    def transition(self, accountId, region, from_status, transition_status):
+        for account, other_region in list(self.regions):
+            if account == accountId and self.status(account, other_region) in ('ENABLING', 'DISABLING'):
+                raise FakeApiError(409, 'ConflictException',
+                                   'A region transition is already in progress')
+        if self.status(accountId, region) == from_status:
+            ready_at = time.monotonic() + random.uniform(self.latency_min, self.latency_max)
+            self.regions[(accountId, region)] = (transition_status, ready_at)
+        return {}
+
+    def dispatch(self, operation, params):
+        accountId = params.get('AccountId', MANAGEMENT_ACCOUNT_ID)
+        if operation == 'getRegionOptStatus':
+            return {
+                'RegionName': params['RegionName'],
+                'RegionOptStatus': self.status(accountId, params['RegionName'])
+            }
+        if operation == 'listRegions':
+            return {'Regions': [
+                {'RegionName': region, 'RegionOptStatus': self.status(accountId, region)}
+                for region in BENCHMARK_REGIONS
+            ]}
+        if operation == 'enableRegion':
+            return self.transition(accountId, params['RegionName'], 'DISABLED', 'ENABLING')
+        if operation == 'disableRegion':
+            return self.transition(accountId, params['RegionName'], 'ENABLED', 'DISABLING')
+        raise ValueError('Unsupported operation {}'.format(operation))
+
+
+class FakeOrganizationsApi(FakeApi):
+    """
+    In-process stand-in for the Organizations API serving a generated org:
+    accounts spread evenly over the root and an OU tree of the given fanout and depth
+    """
+
+    def __init__(self, accounts, ou_fanout=5, ou_depth=3):
+        super().__init__()
+        self.root_id = 'r-root'
+        self.children = {self.root_id: []}
+        self.names = {}
+        self.accounts = {self.root_id: [MANAGEMENT_ACCOUNT_ID]}
+
+        level = [self.root_id]
+        for depth in range(ou_depth):
+            next_level = []
+            for parent in level:
+                for i in range(ou_fanout):
+                    ou_id = 'ou-{}-{}'.format(depth, len(self.names))
+                    self.names[ou_id] = 'OU{}'.format(len(self.names))
+                    self.children[parent].append(ou_id)
+                    self.children[ou_id] = []
+                    self.accounts[ou_id] = []
+                    next_level.append(ou_id)
+            level = next_level
+
+        parents = list(self.children)
+        for i in range(1, accounts):
+            self.accounts[parents[i % len(parents)]].append('{:012d}'.format(i))
+
+    def register(self, client):
+        client.meta.events.register('before-send.organizations', self.handle)
+
+    def unregister(self, client):
+        client.meta.events.unregister('before-send.organizations', self.handle)
+
+    def operation(self, request):
+        target = request.headers['X-Amz-Target']
+        if isinstance(target, bytes):
+            target = target.decode('utf-8')
+        return target.split('.')[-1]
+
+    @staticmethod
+    def page(items, params):
+        start = int(params.get('NextToken') or 0)
+        end = start + ORGANIZATIONS_PAGE_SIZE
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    def dispatch(self, operation, params):
+        if operation == 'DescribeOrganization':
+            return {'Organization': {'Id': 'o-benchmark', 'MasterAccountId': MANAGEMENT_ACCOUNT_ID}}
+        if operation == 'ListRoots':
+            return {'Roots': [{'Id': self.root_id, 'Name': 'Root',
+                               'Arn': 'arn:aws:organizations::{}:root/o-benchmark/{}'.format(
+                                   MANAGEMENT_ACCOUNT_ID, self.root_id)}]}
+        if operation == 'ListOrganizationalUnitsForParent':
+            ous, token = self.page(self.children[params['ParentId']], params)
+            body = {'OrganizationalUnits': [{'Id': ou_id, 'Name': self.names[ou_id]} for ou_id in ous]}
+        elif operation == 'ListAccountsForParent':
+            accounts, token = self.page(self.accounts[params['ParentId']], params)
+            body = {'Accounts': [{'Id': accountId, 'Status': 'ACTIVE'} for accountId in accounts]}
+        else:
+            raise ValueError('Unsupported operation {}'.format(operation))
+        if token:
+            body['NextToken'] = token
+        return body
+
+
+class ThreadSampler:
+    """Samples the number of live threads in the background to record its peak"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        # the sampler thread itself is not part of the measurement
+        self.peak -= 1
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_clients(mode, accounts, concurrency):
+    """
+    Fetches the region status of every account, creating the Account API
+    client either once per account (per-account) or once per worker thread
+    (thread-local, the get_account_client() pool used by region_optin.py)
+    """
+    api = FakeAccountApi()
+    api.register(region_optin.account_session)
+    boto3.setup_default_session()
+    api.register(boto3.DEFAULT_SESSION)
+
+    if mode == 'per-account':
+        # warm up the default session so its lazy setup doesn't race below
+        boto3.client('account', config=region_optin.ACCOUNT_CLIENT_CONFIG)
+
+        def get_client():
+            return boto3.client('account', config=region_optin.ACCOUNT_CLIENT_CONFIG)
+    else:
+        get_client = region_optin.get_account_client
+
+    clients = set()
+
+    def work(accountId):
+        client = get_client()
+        clients.add(id(client))
+        client.get_region_opt_status(AccountId=accountId, RegionName=BENCHMARK_REGION)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(work, ['{:012d}'.format(i) for i in range(accounts)]))
+    elapsed = time.monotonic() - start
+
+    return {
+        'mode': mode,
+        'accounts': accounts,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'clientsCreated': len(clients) if mode != 'per-account' else accounts,
+        'apiCalls': api.total_calls(),
+        'peakRssMb': round(peak_rss_mb(), 1)
+    }
+
+
+def run_opt_in(accounts, mode, args):
+    """
+    Runs org discovery and opt_in() for every benchmark region against the fakes
+    Simulated durations (transition latencies, poll intervals, retry delays)
+    are multiplied by args.time_scale so hours of rollout run in seconds.
+    """
+    scale = args.time_scale
+    region_optin.POLL_INTERVAL = 5 * scale
+    region_optin.MAX_POLL_INTERVAL = 60 * scale
+    region_optin.RETRY_BASE_DELAY = 1 * scale
+    region_optin.MAX_RETRY_DELAY = 20 * scale
+    region_optin.account_throttle = region_optin.AdaptiveThrottle(args.concurrency)
+
+    org_api = FakeOrganizationsApi(accounts, args.ou_fanout, args.ou_depth)
+    org_api.register(region_optin.organizations_client)
+    account_api = FakeAccountApi(args.latency_min * scale, args.latency_max * scale,
+                                 args.throttle_rate)
+    region_optin.account_session = boto3.session.Session()
+    account_api.register(region_optin.account_session)
+
+    regions = BENCHMARK_REGIONS[:args.regions]
+    try:
+        # the script reports progress line by line, keep it out of the results
+        with ThreadSampler() as threads, contextlib.redirect_stdout(io.StringIO()):
+            start = time.monotonic()
+            snapshot = region_optin.get_org_snapshot(args.org_concurrency)
+            all_accounts = region_optin.get_all_accounts_by_ou(snapshot, [])
+            discovered = time.monotonic()
+            metrics = region_optin.opt_in(regions, all_accounts, 'enable', args.concurrency,
+                                          mode == 'central', args.poll_budget / scale,
+                                          args.per_account_limit, snapshot['ManagementAccountId'])
+            finished = time.monotonic()
+    finally:
+        org_api.unregister(region_optin.organizations_client)
+
+    enabled = sum(1 for (accountId, region), (status, ready_at) in account_api.regions.items()
+                  if account_api.status(accountId, region) == 'ENABLED')
+    summary = metrics.summary()
+    throttle = summary['AccountApi']
+
+    return {
+        'accounts': accounts,
+        'regions': len(regions),
+        'mode': mode,
+        'discoverySec': round(discovered - start, 2),
+        'makespanSec': round(finished - start, 2),
+        'simulatedMin': round((finished - start) / scale / 60, 1),
+        'enabled': enabled,
+        'orgCalls': org_api.total_calls(),
+        'accountCalls': account_api.total_calls(),
+        'throttled': throttle['Throttled'],
+        # API round trips are not simulated, so this one is in real time
+        'p95FirstResponseMs': round(summary['FirstResponseSec']['P95'] * 1000, 1),
+        'p95Polls': summary['Polls']['P95'],
+        'peakThreads': threads.peak
+    }
+
+
+def run_isolated(command, mode, args):
+    """Runs one benchmark mode in a fresh interpreter so peak RSS is not shared"""
+    cmd = [sys.executable, os.path.abspath(__file__), command, '--mode', mode,
+           '--accounts', str(args.accounts), '--concurrency', str(args.concurrency)]
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_table(results):
+    columns = list(results[0].keys())
+    widths = [max(len(str(c)), *(len(str(r[c])) for r in results)) for c in columns]
+    print('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks for region_optin.py against in-process Organizations and Account APIs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    clients = subparsers.add_parser(
+        'clients', help='Compare per-account and thread-local Account API clients')
+    clients.add_argument('--accounts', type=int, default=2000)
+    clients.add_argument('--concurrency', type=int, default=15)
+    clients.add_argument('--mode', choices=['per-account', 'thread-local'],
+                         help='Run a single mode in this process and print its JSON result')
+
+    opt_in = subparsers.add_parser(
+        'opt-in', help='Measure org discovery and region opt-in makespan, API calls and threads')
+    opt_in.add_argument('--accounts', type=int, nargs='+', default=[100, 1000],
+                        help='Org sizes to simulate')
+    opt_in.add_argument('--regions', type=int, default=1, choices=range(1, len(BENCHMARK_REGIONS) + 1),
+                        help='Number of opt-in regions enabled in the run')
+    opt_in.add_argument('--modes', nargs='+', choices=['worker', 'central'], default=['worker', 'central'],
+                        help='worker: each worker polls its own account, central: --CentralPoller')
+    opt_in.add_argument('--concurrency', type=int, default=15)
+    opt_in.add_argument('--per-account-limit', type=int, default=1)
+    opt_in.add_argument('--poll-budget', type=float, default=5,
+                        help='Central poller requests per simulated second')
+    opt_in.add_argument('--org-concurrency', type=int, default=4)
+    opt_in.add_argument('--ou-fanout', type=int, default=5)
+    opt_in.add_argument('--ou-depth', type=int, default=3)
+    opt_in.add_argument('--latency-min', type=float, default=60,
+                        help='Shortest simulated region transition in seconds')
+    opt_in.add_argument('--latency-max', type=float, default=600,
+                        help='Longest simulated region transition in seconds')
+    opt_in.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of Account API requests answered with TooManyRequestsException')
+    opt_in.add_argument('--time-scale', type=float, default=0.001,
+                        help='Real seconds per simulated second')
+    opt_in.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == 'clients':
+        if args.mode:
+            print(json.dumps(run_clients(args.mode, args.accounts, args.concurrency)))
+            return
+        print_table([run_isolated('clients', mode, args)
+                     for mode in ['per-account', 'thread-local']])
+    elif args.command == 'opt-in':
+        random.seed(args.seed)
+        print_table([run_opt_in(accounts, mode, args)
+                     for accounts in args.accounts for mode in args.modes])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,381 @@
 import os
+import csv
+import json
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
 import sys
 import threading
 import argparse
 import time
+import heapq
+import math
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 parser = argparse.ArgumentParser(
     description='A development script that enables opt-in regions across all accounts. Use Administrator AWS credentials in the root account when running this script.'
 )
 parser.add_argument(
     '--OptInRegion',
-    help='The opt-in region to enable/disable',
-    required=True)
+    nargs='+',
+    help='The opt-in regions to enable/disable (separated by spaces or commas). Optional for the status action, which reports every opt-in region when omitted')
 parser.add_argument(
     '--IgnoreOU',
-    default='Ignore',
-    help='AWS Accounts in this OU will be ignored')
+    nargs='+',
+    default=['Ignore'],
+    help='AWS Accounts in these OUs (name or id, at any depth) will be ignored')
 parser.add_argument(
     '--Action',
     default='Enable',
     help='AWS Accounts in this OU will be ignored',
     required=True)
+parser.add_argument(
+    '--Concurrency',
+    type=int,
+    default=15,
+    help='Maximum number of account-region pairs processed in parallel')
+parser.add_argument(
+    '--PerAccountLimit',
+    type=int,
+    default=1,
+    help='Maximum number of region transitions in progress at the same time in one account')
+parser.add_argument(
+    '--CentralPoller',
+    action='store_true',
+    help='Workers only submit the enable/disable request and a single poller tracks every in-flight account')
+parser.add_argument(
+    '--PollBudget',
+    type=float,
+    default=5,
+    help='Maximum status requests per second made by the central poller across all accounts')
+parser.add_argument(
+    '--StatusOutput',
+    help='File where the status action writes the account x opt-in region matrix')
+parser.add_argument(
+    '--StatusFormat',
+    choices=['csv', 'json'],
+    default='csv',
+    help='Format of the --StatusOutput file')
+parser.add_argument(
+    '--Journal',
+    default='region_optin_journal.jsonl',
+    help='Append-only JSON Lines journal of the state of every account-region transition')
+parser.add_argument(
+    '--Resume',
+    action='store_true',
+    help='Skip transitions completed in --Journal and go straight back to polling the in-flight ones')
+parser.add_argument(
+    '--MetricsFile',
+    help='JSON file where the per account-region timings and their percentiles are written')
+parser.add_argument(
+    '--OrgCache',
+    help='File where the account and OU snapshot of the organization is cached. Defaults to org_snapshot_<organization id>.json')
+parser.add_argument(
+    '--OrgCacheTTL',
+    type=int,
+    help='Seconds the cached org snapshot is reused before walking the organization again. 0 disables the cache. '
+         'Defaults to 3600 for the status action and 0 for enable/disable, so they always see new accounts and OU moves')
+parser.add_argument(
+    '--OrgConcurrency',
+    type=int,
+    default=4,
+    help='Maximum number of OUs listed in parallel while walking the organization')
+
+# Seconds between status polls while a region is ENABLING/DISABLING. The
+# central poller starts at POLL_INTERVAL and backs off up to MAX_POLL_INTERVAL.
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
+MAX_POLL_ERRORS = 5
+
+# list_regions returns every region unless filtered; regions enabled by default
+# can't be opted in or out so they are left out of the status matrix.
+OPT_IN_REGION_STATUSES = ['ENABLED', 'ENABLING', 'DISABLING', 'DISABLED']
+
+# Region status before, during and after the transition for each action
+TRANSITION_STATUSES = {
+    'enable': ('DISABLED', 'ENABLING', 'ENABLED'),
+    'disable': ('ENABLED', 'DISABLING', 'DISABLED')
+}
+
+# Journal states. A resumed run skips terminal transitions and goes straight
+# back to polling in-flight ones; failed transitions are attempted again.
+JOURNAL_TERMINAL_STATES = ['COMPLETED', 'SKIPPED']
+JOURNAL_IN_FLIGHT_STATES = ['SUBMITTED', 'POLLING']
+
+# Throttling and transient errors are retried by AdaptiveThrottle instead of
+# botocore so the controller sees every throttled call and can adjust to it.
+ACCOUNT_CLIENT_CONFIG = Config(
+    retries={
+        'max_attempts': 1,
+        'mode': 'standard'
+    }
+)
+
+THROTTLING_ERROR_CODES = ['TooManyRequestsException', 'ThrottlingException']
+TRANSIENT_ERROR_CODES = ['InternalServerException', 'ResourceUnavailableException']
+MAX_API_RETRIES = 8
+RETRY_BASE_DELAY = 1
+MAX_RETRY_DELAY = 20
 
 organizations_client = boto3.client('organizations')
-account_client = boto3.client('account')
 sts = boto3.client('sts')
 
+# Creating a client loads the service model and endpoint rules, so each worker
+# thread builds one Account API client on first use and reuses it for every
+# account it processes. Clients are created from one shared session (which
+# caches the loaded models) under a lock, as client creation isn't thread safe.
+account_session = boto3.session.Session()
+account_client_lock = threading.Lock()
+account_clients = threading.local()
 
-def get_all_accounts_by_ou(parentId, organizationUnits,
-                           organizationUnitsToSkip):
-    all_accounts = []
-    if parentId is None:
-        paginator = organizations_client.get_paginator('list_roots')
-        page_iterator = paginator.paginate()
-        for root_item in page_iterator:
-            item = root_item['Roots'][0]
-            if item['Name'] == 'Root' and item['Id'] and item['Arn']:
-                parentId = item['Id']
-                break
 
+def get_account_client():
+    """Returns the Account API client of the calling thread"""
+    client = getattr(account_clients, 'client', None)
+    if client is None:
+        with account_client_lock:
+            client = account_session.client('account', config=ACCOUNT_CLIENT_CONFIG)
+        account_clients.client = client
+    return client
+
+
+class AdaptiveThrottle:
+    """
+    AIMD controller of the number of Account API requests in flight, shared by
+    every worker and the status poller.
+
+    Each successful call grows the limit by 1/limit (about one more request
+    per round trip) up to max_limit and a throttled call halves it. Only calls
+    sent after the last decrease can halve it again, so a burst of throttles
+    caused by the same limit only counts once. Throttled and transient errors
+    are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, max_limit, initial_limit=None):
+        self._max_limit = max(1, max_limit)
+        self._limit = float(initial_limit or max(1, self._max_limit // 2))
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self._started = None
+        self._finished = None
+        self._last_call = threading.local()
+
+    def call(self, method, **kwargs):
+        """Calls method(**kwargs) within the in-flight limit, retrying throttling and transient errors"""
+        attempt = 0
+        while True:
+            sent = self._acquire()
+            self._last_call.retries = attempt
+            outcome = 'error'
+            try:
+                result = method(**kwargs)
+                outcome = 'success'
+                return result
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in THROTTLING_ERROR_CODES:
+                    outcome = 'throttled'
+                elif code not in TRANSIENT_ERROR_CODES:
+                    raise
+                if attempt >= MAX_API_RETRIES:
+                    raise
+            except (BotocoreConnectionError, HTTPClientError):
+                if attempt >= MAX_API_RETRIES:
+                    raise
+            finally:
+                self._release(outcome, sent)
+
+            attempt += 1
+            with self._condition:
+                self.retries += 1
+            time.sleep(random.uniform(0, min(MAX_RETRY_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+    def last_retries(self):
+        """Number of retries of the last call made by the calling thread"""
+        return getattr(self._last_call, 'retries', 0)
+
+    def _acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+            sent = time.monotonic()
+            if self._started is None:
+                self._started = sent
+            return sent
+
+    def _release(self, outcome, sent):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if outcome == 'throttled':
+                self.throttled += 1
+                if sent > self._last_decrease:
+                    self._limit = max(1.0, self._limit / 2)
+                    self._last_decrease = now
+            elif outcome == 'success':
+                self.calls += 1
+                self._finished = now
+                self._limit = min(float(self._max_limit), self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+    def report(self):
+        """Returns the call counts and the sustained rate of successful calls"""
+        with self._condition:
+            elapsed = (self._finished - self._started) if self._finished else 0
+            return {
+                'Calls': self.calls,
+                'Throttled': self.throttled,
+                'Retries': self.retries,
+                'Limit': int(self._limit),
+                'SustainedTPS': round(self.calls / elapsed, 2) if elapsed > 0 else 0
+            }
+
+    def print_report(self):
+        report = self.report()
+        print('Account API: {} successful calls, {} throttled, {} retries, sustained {} TPS, final in-flight limit {}'.format(
+            report['Calls'], report['Throttled'], report['Retries'],
+            report['SustainedTPS'], report['Limit']))
+
+
+account_throttle = AdaptiveThrottle(15)
+
+
+def get_root_id():
+    paginator = organizations_client.get_paginator('list_roots')
+    page_iterator = paginator.paginate()
+    for root_item in page_iterator:
+        for item in root_item['Roots']:
+            if item['Id'] and item['Arn']:
+                return item['Id']
+    raise ValueError('Organization root not found')
+
+
+def get_ous_by_parentId(parent_id):
+    all_ous = []
     paginator = organizations_client.get_paginator(
         'list_organizational_units_for_parent')
-    page_iterator = paginator.paginate(ParentId=parentId)
+    page_iterator = paginator.paginate(ParentId=parent_id)
     for ous_paged in page_iterator:
         for ou in ous_paged['OrganizationalUnits']:
-            if ou['Name'] not in organizationUnitsToSkip:
-                all_accounts = all_accounts + \
-                    get_accounts_by_parentId(ou['Id'])
+            all_ous.append({'Id': ou['Id'], 'Name': ou['Name']})
+    return all_ous
+
+
+def get_org_snapshot(concurrency=4, aws_organziation=None):
+    """
+    Walks the whole OU tree breadth-first, listing the child OUs and accounts
+    of every OU of a level in parallel
+    aws_organziation: describe_organization response, described again when omitted
+    Returns {'OrganizationId', 'RootId', 'ManagementAccountId',
+             'OrganizationalUnits': {ouId: {'Name', 'ParentId'}}, 'Accounts': {accountId: parentId}}
+    """
+    if aws_organziation is None:
+        aws_organziation = organizations_client.describe_organization()
+    rootId = get_root_id()
+    snapshot = {
+        'CreatedAt': time.time(),
+        'OrganizationId': aws_organziation['Organization']['Id'],
+        'RootId': rootId,
+        'ManagementAccountId': aws_organziation['Organization']['MasterAccountId'],
+        'OrganizationalUnits': {},
+        'Accounts': {}
+    }
 
-    all_accounts = all_accounts + get_accounts_by_parentId(parentId)       
+    def list_children(parent_id):
+        return get_ous_by_parentId(parent_id), get_accounts_by_parentId(parent_id)
 
-    return all_accounts
+    level = [rootId]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while level:
+            next_level = []
+            for parent_id, (ous, accounts) in zip(level, executor.map(list_children, level)):
+                for ou in ous:
+                    snapshot['OrganizationalUnits'][ou['Id']] = {
+                        'Name': ou['Name'], 'ParentId': parent_id}
+                    next_level.append(ou['Id'])
+                for accountId in accounts:
+                    snapshot['Accounts'][accountId] = parent_id
+            level = next_level
+
+    print('Found {} accounts in {} OUs'.format(
+        len(snapshot['Accounts']), len(snapshot['OrganizationalUnits'])))
+    return snapshot
+
+
+def load_org_snapshot(cache_file, ttl, concurrency=4):
+    """
+    Returns the org snapshot from cache_file when it is younger than ttl seconds
+    and was taken from the organization of the caller, otherwise walks the
+    organization and refreshes cache_file
+    cache_file: defaults to org_snapshot_<organization id>.json
+    """
+    if ttl <= 0:
+        return get_org_snapshot(concurrency)
+
+    aws_organziation = organizations_client.describe_organization()
+    organizationId = aws_organziation['Organization']['Id']
+    if not cache_file:
+        cache_file = 'org_snapshot_{}.json'.format(organizationId)
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                snapshot = json.load(f)
+            age = time.time() - snapshot['CreatedAt']
+            if snapshot.get('OrganizationId') != organizationId:
+                print('Ignoring org snapshot {} of another organization ({})'.format(
+                    cache_file, snapshot.get('OrganizationId')))
+            elif 0 <= age < ttl:
+                print('Using org snapshot from {} ({:.0f}s old)'.format(cache_file, age))
+                return snapshot
+        except (ValueError, KeyError) as e:
+            print('Ignoring invalid org snapshot {}: {}'.format(cache_file, e))
+
+    snapshot = get_org_snapshot(concurrency, aws_organziation)
+
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_file, cache_file)
+
+    return snapshot
+
+
+def get_all_accounts_by_ou(snapshot, organizationUnitsToSkip):
+    """
+    Returns the account ids of the snapshot, except those nested at any depth
+    in an OU whose name or id is in organizationUnitsToSkip
+    """
+    ous = snapshot['OrganizationalUnits']
+    skipped = {}
+
+    def is_skipped(parent_id):
+        path = []
+        result = False
+        while parent_id in ous:
+            if parent_id in skipped:
+                result = skipped[parent_id]
+                break
+            path.append(parent_id)
+            if parent_id in organizationUnitsToSkip or \
+                    ous[parent_id]['Name'] in organizationUnitsToSkip:
+                result = True
+                break
+            parent_id = ous[parent_id]['ParentId']
+        for ou_id in path:
+            skipped[ou_id] = result
+        return result
+
+    return [accountId for accountId, parent_id in snapshot['Accounts'].items()
+            if not is_skipped(parent_id)]
 
 
 def get_accounts_by_parentId(parent_id):
@@ -64,103 +388,728 @@ def get_accounts_by_parentId(parent_id):
     return all_aws_accounts
 
 
-def opt_in(region, all_accounts, action):
-    print('Opting in accounts for {}'.format(region))
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+class OptInMetrics:
+    """
+    Per account-region timings of an opt-in run: time to the first Account API
+    response, ENABLING->ENABLED (or DISABLING->DISABLED) duration, number of
+    status polls and retries. summary() reduces them to p50/p95/p99 and a
+    histogram of power-of-two second buckets.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._transitions = {}
+
+    def _entry(self, accountId, region):
+        key = (accountId, region)
+        if key not in self._transitions:
+            self._transitions[key] = {
+                'AccountId': accountId,
+                'RegionName': region,
+                'Started': time.monotonic(),
+                'FirstResponseSec': None,
+                'Submitted': None,
+                'TransitionSec': None,
+                'Polls': 0,
+                'Retries': 0,
+                'Outcome': None
+            }
+        return self._transitions[key]
+
+    def started(self, accountId, region):
+        with self._lock:
+            self._entry(accountId, region)['Started'] = time.monotonic()
+
+    def responded(self, accountId, region, retries=0):
+        """Records one Account API response for the transition"""
+        with self._lock:
+            entry = self._entry(accountId, region)
+            if entry['FirstResponseSec'] is None:
+                entry['FirstResponseSec'] = time.monotonic() - entry['Started']
+            entry['Retries'] += retries
+
+    def submitted(self, accountId, region):
+        with self._lock:
+            self._entry(accountId, region)['Submitted'] = time.monotonic()
+
+    def polled(self, accountId, region):
+        with self._lock:
+            self._entry(accountId, region)['Polls'] += 1
+
+    def completed(self, accountId, region, outcome):
+        with self._lock:
+            entry = self._entry(accountId, region)
+            entry['Outcome'] = outcome
+            if outcome == 'COMPLETED' and entry['Submitted'] is not None:
+                entry['TransitionSec'] = time.monotonic() - entry['Submitted']
+
+    @staticmethod
+    def distribution(values):
+        values = sorted(round(value, 3) for value in values)
+        histogram = {}
+        for value in values:
+            bucket = 1
+            while bucket < value:
+                bucket *= 2
+            label = '<={}'.format(bucket)
+            histogram[label] = histogram.get(label, 0) + 1
+        return {
+            'Count': len(values),
+            'Min': values[0] if values else None,
+            'P50': percentile(values, 50),
+            'P95': percentile(values, 95),
+            'P99': percentile(values, 99),
+            'Max': values[-1] if values else None,
+            'Histogram': histogram
+        }
+
+    def summary(self):
+        with self._lock:
+            transitions = list(self._transitions.values())
+        outcomes = {}
+        for entry in transitions:
+            outcomes[entry['Outcome']] = outcomes.get(entry['Outcome'], 0) + 1
+        return {
+            'ElapsedSec': round(time.monotonic() - self._started, 3),
+            'Transitions': len(transitions),
+            'Outcomes': outcomes,
+            'FirstResponseSec': self.distribution(
+                [e['FirstResponseSec'] for e in transitions if e['FirstResponseSec'] is not None]),
+            'TransitionSec': self.distribution(
+                [e['TransitionSec'] for e in transitions if e['TransitionSec'] is not None]),
+            'Polls': self.distribution([e['Polls'] for e in transitions]),
+            'Retries': self.distribution([e['Retries'] for e in transitions]),
+            'AccountApi': account_throttle.report()
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print('Transitions: {} in {:.0f}s {}'.format(
+            summary['Transitions'], summary['ElapsedSec'], summary['Outcomes']))
+        for name in ['FirstResponseSec', 'TransitionSec', 'Polls', 'Retries']:
+            d = summary[name]
+            if d['Count']:
+                print('{:<17} p50 {:>8.1f}  p95 {:>8.1f}  p99 {:>8.1f}  max {:>8.1f}'.format(
+                    name, d['P50'], d['P95'], d['P99'], d['Max']))
+
+    def write(self, output_file):
+        with self._lock:
+            transitions = [{k: v for k, v in entry.items() if k not in ('Started', 'Submitted')}
+                           for entry in self._transitions.values()]
+        with open(output_file, 'w') as f:
+            json.dump({'Summary': self.summary(), 'Transitions': transitions}, f, indent=2)
+        print('Metrics saved to {}'.format(output_file))
+
+
+class OptInJournal:
+    """
+    Append-only JSON Lines journal of account-region transitions.
+    Each run starts with a STARTED line of its action and regions, then each
+    line records the state of one transition: SUBMITTED, POLLING, COMPLETED,
+    SKIPPED or FAILED. Nothing is written when path is None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            self._file = open(path, 'a+')
+            # terminate a line cut short when the previous run died
+            if self._file.tell() > 0:
+                self._file.seek(self._file.tell() - 1)
+                if self._file.read(1) != '\n':
+                    self._file.write('\n')
+
+    def start(self, action, regions):
+        """Records the start of a run of action on regions, earlier entries are no longer resumed"""
+        if self._file is None:
+            return
+        line = {'Time': time.time(), 'Action': action, 'Regions': sorted(regions), 'State': 'STARTED'}
+        with self._lock:
+            self._file.write(json.dumps(line) + '\n')
+            self._file.flush()
+
+    def record(self, accountId, region, action, state, **details):
+        if self._file is None:
+            return
+        line = dict(details, Time=time.time(), AccountId=accountId,
+                    RegionName=region, Action=action, State=state)
+        with self._lock:
+            self._file.write(json.dumps(line) + '\n')
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def load(path, action, regions):
+        """
+        Returns the last journal entry of each (accountId, region, action) recorded
+        since the last run of action on the same regions started, or None when
+        the journal has no such run
+        """
+        entries = None
+        if not path or not os.path.exists(path):
+            return entries
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    if entry['State'] == 'STARTED':
+                        # entries of older runs may have been undone since, e.g. by a disable run
+                        if entry['Action'] == action and entry['Regions'] == sorted(regions):
+                            entries = {}
+                        continue
+                    if entries is not None:
+                        entries[(entry['AccountId'], entry['RegionName'], entry['Action'])] = entry
+                except (ValueError, KeyError):
+                    # a line cut short when the previous run died
+                    continue
+        return entries
+
+
+class RegionStatusPoller:
+    """
+    Single thread that polls the opt-in status of every in-flight account.
 
+    Each account is polled with exponential backoff (POLL_INTERVAL doubling up
+    to MAX_POLL_INTERVAL) and all polls share one global budget of
+    get_region_opt_status requests per second.
+    """
+
+    def __init__(self, requests_per_second, journal=None, metrics=None):
+        self._min_spacing = 1.0 / requests_per_second
+        self._journal = journal or OptInJournal(None)
+        self._metrics = metrics or OptInMetrics()
+        self._heap = []
+        self._sequence = 0
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def track(self, accountId, region, action, on_complete=None):
+        """
+        Start polling accountId until region reaches the final status of action
+        on_complete: called once the account is done, or the poller gave up on it
+        """
+        entry = {
+            'AccountId': accountId,
+            'RegionName': region,
+            'Action': action,
+            'TargetStatus': TRANSITION_STATUSES[action][2],
+            'Polls': 0,
+            'Interval': POLL_INTERVAL,
+            'Errors': 0,
+            'OnComplete': on_complete
+        }
+        with self._condition:
+            self._pending += 1
+            self._schedule(entry, POLL_INTERVAL)
+            self._condition.notify()
+
+    def close(self):
+        """No more accounts will be tracked; the poller exits once all are done"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def join(self):
+        self._thread.join()
+
+    def _schedule(self, entry, delay):
+        self._sequence += 1
+        heapq.heappush(
+            self._heap, (time.monotonic() + delay, self._sequence, entry))
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                if not self._heap:
+                    if self._closed and self._pending == 0:
+                        return None
+                    self._condition.wait()
+                    continue
+                due = self._heap[0][0] - time.monotonic()
+                if due <= 0:
+                    return heapq.heappop(self._heap)[2]
+                self._condition.wait(timeout=due)
+
+    def _finish(self, entry):
+        if entry['OnComplete'] is not None:
+            entry['OnComplete']()
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify()
+
+    def _run(self):
+        account_client_poller = get_account_client()
+        last_request = 0
+
+        while True:
+            entry = self._next_due()
+            if entry is None:
+                return
+
+            wait = last_request + self._min_spacing - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            last_request = time.monotonic()
+
+            accountId = entry['AccountId']
+            region = entry['RegionName']
+            try:
+                region_status = account_throttle.call(
+                    account_client_poller.get_region_opt_status,
+                    AccountId=accountId, RegionName=region)
+            except Exception as e:
+                entry['Errors'] += 1
+                print('Error polling {} for {}: {}'.format(region, accountId, e))
+                if entry['Errors'] >= MAX_POLL_ERRORS:
+                    print('Giving up on {} for {} after {} errors'.format(
+                        region, accountId, entry['Errors']))
+                    self._journal.record(accountId, region, entry['Action'], 'FAILED',
+                                         Error=str(e))
+                    self._metrics.completed(accountId, region, 'FAILED')
+                    self._finish(entry)
+                    continue
+            else:
+                entry['Errors'] = 0
+                entry['Polls'] += 1
+                self._metrics.responded(accountId, region, account_throttle.last_retries())
+                self._metrics.polled(accountId, region)
+                status = region_status['RegionOptStatus']
+                print('Status: {} {} for {}'.format(status, region, accountId))
+                if status == entry['TargetStatus']:
+                    print('{} {} for {}. Done'.format(status, region, accountId))
+                    self._journal.record(accountId, region, entry['Action'], 'COMPLETED',
+                                         RegionOptStatus=status)
+                    self._metrics.completed(accountId, region, 'COMPLETED')
+                    self._finish(entry)
+                    continue
+                if entry['Polls'] == 1:
+                    self._journal.record(accountId, region, entry['Action'], 'POLLING',
+                                         RegionOptStatus=status)
+
+            entry['Interval'] = min(entry['Interval'] * 2, MAX_POLL_INTERVAL)
+            with self._condition:
+                self._schedule(entry, entry['Interval'])
+
+
+class TransitionScheduler:
+    """
+    Feeds every (account, region) pair through one shared worker pool.
+
+    The Account API only allows a limited number of region transitions per
+    account at a time, so at most per_account_limit regions of an account are
+    queued or in-flight; the next region of the account is queued as soon as
+    one of its transitions completes.
+    """
+
+    def __init__(self, executor, work, per_account_limit=1):
+        self._executor = executor
+        self._work = work
+        self._per_account_limit = per_account_limit
+        self._pending = {}
+        self._in_flight = {}
+        self._total = 0
+        self._completed = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def add(self, accountId, region):
+        self._pending.setdefault(accountId, deque()).append(region)
+        self._in_flight.setdefault(accountId, 0)
+        self._total += 1
+
+    def start(self):
+        with self._condition:
+            for accountId in self._pending:
+                self._submit_next(accountId)
+
+    def release(self, accountId):
+        """Called once the transition of a region of accountId is complete"""
+        with self._condition:
+            self._in_flight[accountId] -= 1
+            self._completed += 1
+            print('Progress: {}/{} account-region transitions complete'.format(
+                self._completed, self._total))
+            self._submit_next(accountId)
+            self._condition.notify_all()
+
+    def wait(self):
+        with self._condition:
+            while self._completed < self._total:
+                # wake up regularly so KeyboardInterrupt is handled promptly
+                self._condition.wait(timeout=1)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+
+    def _submit_next(self, accountId):
+        pending = self._pending[accountId]
+        while pending and not self._stopped and \
+                self._in_flight[accountId] < self._per_account_limit:
+            region = pending.popleft()
+            self._in_flight[accountId] += 1
+            self._executor.submit(self._run, accountId, region)
+
+    def _run(self, accountId, region):
+        tracked = False
+        try:
+            tracked = self._work(region, accountId, lambda: self.release(accountId))
+        except Exception as e:
+            print('Error processing {} for {}: {}'.format(region, accountId, e))
+        finally:
+            if not tracked:
+                self.release(accountId)
+
+
+def get_management_account_id():
     aws_organziation = organizations_client.describe_organization()
+    return aws_organziation['Organization']['MasterAccountId']
+
+
+def opt_in(regions, all_accounts, action, concurrency=15, central_poller=False,
+           poll_budget=5, per_account_limit=1, rootAccountId=None,
+           journal_file=None, resume=False, metrics_file=None):
+    """Returns the OptInMetrics of the run"""
+    if isinstance(regions, str):
+        regions = [regions]
+
+    previous = OptInJournal.load(journal_file, action, regions) if resume else None
+    journal = OptInJournal(journal_file)
+    if previous is None:
+        if resume:
+            print('No {} run on {} to resume in {}, starting a new run'.format(
+                action, ', '.join(regions), journal_file))
+        previous = {}
+        journal.start(action, regions)
+    metrics = OptInMetrics()
+
+    print('Opting in accounts for {}'.format(', '.join(regions)))
+
+    if rootAccountId is None:
+        rootAccountId = get_management_account_id()
+
+    print('Opt-in for {} for management account {} must be done manually first'.format(', '.join(regions), rootAccountId))
+
+    accounts = [accountId for accountId in all_accounts if accountId != rootAccountId]
+    print('Processing {} accounts across {} regions with {} workers'.format(
+        len(accounts), len(regions), concurrency))
+
+    poller = None
+    if central_poller:
+        poller = RegionStatusPoller(poll_budget, journal, metrics)
+        poller.start()
+
+    in_flight = set()
 
-    rootAccountId = aws_organziation['Organization']['MasterAccountId']
+    def work(region, accountId, on_complete):
+        try:
+            return thread_opt_in(region, accountId, action, poller, on_complete,
+                                 journal, (accountId, region) in in_flight, metrics)
+        except Exception as e:
+            journal.record(accountId, region, action, 'FAILED', Error=str(e))
+            metrics.completed(accountId, region, 'FAILED')
+            raise
+
+    # Pairs are queued on a bounded pool: as soon as a worker finishes an
+    # account-region pair it picks up the next one, so a single slow
+    # enable_region only holds one worker instead of stalling a whole batch.
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    scheduler = TransitionScheduler(executor, work, per_account_limit)
+    completed = 0
+    for accountId in accounts:
+        for region in regions:
+            state = previous.get((accountId, region, action), {}).get('State')
+            if state in JOURNAL_TERMINAL_STATES:
+                completed += 1
+                continue
+            if state in JOURNAL_IN_FLIGHT_STATES:
+                in_flight.add((accountId, region))
+            scheduler.add(accountId, region)
 
-    print('Opt-in for {} for management account {} must be done manually first'.format(region, rootAccountId))
+    if resume:
+        print('Resuming from {}: {} transitions already complete, {} in flight'.format(
+            journal_file, completed, len(in_flight)))
 
-    threads = list()
     try:
-        count = 0
-        for accountId in all_accounts:
-            count = count + 1
-            if count % 15 == 0:
-                for index, thread in enumerate(threads):
-                    thread.join()
-            if accountId != rootAccountId:
-                t = threading.Thread(
-                    target=thread_opt_in, args=(
-                        region, accountId,action))
-                threads.append(t)
-                t.start()
+        scheduler.start()
+        scheduler.wait()
     except BaseException:
         print('Error', sys.exc_info()[0], 'occurred')
+        scheduler.stop()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
     finally:
-        for index, thread in enumerate(threads):
-            thread.join()
+        executor.shutdown(wait=True)
         print('Done. All opt in threads finished')
 
+    if poller is not None:
+        poller.close()
+        poller.join()
+        print('Done. Status poller finished')
+
+    journal.close()
+
+    account_throttle.print_report()
+    metrics.print_summary()
+    if metrics_file:
+        metrics.write(metrics_file)
+
+    return metrics
 
-def thread_opt_in(region, accountId,action):
+
+def thread_opt_in(region, accountId, action, poller=None, on_complete=None,
+                  journal=None, in_flight=False, metrics=None):
+    """
+    Enables or disables region for accountId
+    With a poller, returns True once the transition was handed over to it
+    instead of waiting for the region to reach its final status
+    in_flight: the journal of a previous run has the transition in flight. It
+    is only waited for if the region is still transitioning, and submitted
+    again if the region is back in its status before the transition
+    """
     print('Processing {} for {} in TID={}'.format(
         region, accountId, threading.get_ident()))
 
-    config = Config(
-        retries={
-            'max_attempts': 3,
-            'mode': 'standard'
-        }
-    )
-
-    account_client_tr = boto3.client('account', config=config)
+    journal = journal or OptInJournal(None)
+    metrics = metrics or OptInMetrics()
+    metrics.started(accountId, region)
+    account_client_tr = get_account_client()
 
-    region_status = account_client_tr.get_region_opt_status(
+    resumed = in_flight
+    region_status = account_throttle.call(
+        account_client_tr.get_region_opt_status,
         AccountId=accountId, RegionName=region)
+    metrics.responded(accountId, region, account_throttle.last_retries())
 
     print(
         '{} is {} for {}'.format(
             region_status['RegionName'],
             region_status['RegionOptStatus'],
             accountId))
-    
-    if action == "status":
-        return
 
-    #Enable region if disabled
-    if region_status['RegionOptStatus'] == 'DISABLED' and action=="enable":
-        print('Enabling {} for {}...'.format(region, accountId))
-        try:
-            account_client_tr.enable_region(
+    if action not in TRANSITION_STATUSES:
+        return False
+
+    from_status, transition_status, target_status = TRANSITION_STATUSES[action]
+    status = region_status['RegionOptStatus']
+    # a transition already in progress (e.g. started by a run that died
+    # without a journal) only needs to be waited for
+    in_flight = status == transition_status
+    if resumed and status == target_status:
+        journal.record(accountId, region, action, 'COMPLETED', RegionOptStatus=status)
+        metrics.completed(accountId, region, 'COMPLETED')
+        return False
+    if resumed and status == from_status:
+        print('{} is back to {} for {}, the transition of the previous run did not complete. Submitting it again'.format(
+            region, status, accountId))
+    elif not in_flight and status != from_status:
+        journal.record(accountId, region, action, 'SKIPPED', RegionOptStatus=status)
+        metrics.completed(accountId, region, 'SKIPPED')
+        return False
+
+    #Enable region if disabled, disable region if enabled
+    verb = 'Enabling' if action == 'enable' else 'Disabling'
+    print('{} {} for {}...'.format(verb, region, accountId))
+    try:
+        if not in_flight:
+            account_throttle.call(
+                getattr(account_client_tr, '{}_region'.format(action)),
                 AccountId=accountId, RegionName=region)
-            status = None
-            while status != 'ENABLED':
-                time.sleep(5)
-                region_status = account_client_tr.get_region_opt_status(
-                    AccountId=accountId, RegionName=region)
-                status = region_status['RegionOptStatus']
-                print(
-                    'Status: {} {} for {}'.format(
-                        status, region, accountId))
-        finally:
-            print('Enabling {} for {}. Done'.format(region, accountId))
+            metrics.responded(accountId, region, account_throttle.last_retries())
+            metrics.submitted(accountId, region)
+            journal.record(accountId, region, action, 'SUBMITTED')
+        if poller is not None:
+            poller.track(accountId, region, action, on_complete)
+            return True
+        wait_for_region_status(account_client_tr, region, accountId, action, journal, metrics)
+    finally:
+        print('{} {} for {}. {}'.format(
+            verb, region, accountId, 'Submitted' if poller is not None else 'Done'))
+
+    return False
 
-    #Disable region if enabled
 
-    if region_status['RegionOptStatus'] == 'ENABLED' and action=="disable":
-        print('Disabling {} for {}...'.format(region, accountId))
+def wait_for_region_status(account_client_tr, region, accountId, action, journal, metrics):
+    """
+    Polls the region status every POLL_INTERVAL seconds until the transition of action is complete
+    Gives up and records the transition as FAILED after MAX_POLL_ERRORS consecutive polling errors
+    """
+    target_status = TRANSITION_STATUSES[action][2]
+    status = None
+    polls = 0
+    errors = 0
+    while status != target_status:
+        time.sleep(POLL_INTERVAL)
         try:
-            account_client_tr.disable_region(
+            region_status = account_throttle.call(
+                account_client_tr.get_region_opt_status,
                 AccountId=accountId, RegionName=region)
-            status = None
-            while status != 'DISABLED':
-                time.sleep(5)
-                region_status = account_client_tr.get_region_opt_status(
-                    AccountId=accountId, RegionName=region)
-                status = region_status['RegionOptStatus']
-                print(
-                    'Status: {} {} for {}'.format(
-                        status, region, accountId))
-        finally:
-            print('Disabling {} for {}. Done'.format(region, accountId))
+        except Exception as e:
+            errors += 1
+            print('Error polling {} for {}: {}'.format(region, accountId, e))
+            if errors >= MAX_POLL_ERRORS:
+                print('Giving up on {} for {} after {} errors'.format(region, accountId, errors))
+                journal.record(accountId, region, action, 'FAILED', Error=str(e))
+                metrics.completed(accountId, region, 'FAILED')
+                return
+            continue
+        errors = 0
+        status = region_status['RegionOptStatus']
+        polls += 1
+        metrics.responded(accountId, region, account_throttle.last_retries())
+        metrics.polled(accountId, region)
+        print(
+            'Status: {} {} for {}'.format(
+                status, region, accountId))
+        if polls == 1 and status != target_status:
+            journal.record(accountId, region, action, 'POLLING', RegionOptStatus=status)
+
+    journal.record(accountId, region, action, 'COMPLETED', RegionOptStatus=status)
+    metrics.completed(accountId, region, 'COMPLETED')
+
+
+def get_account_regions_status(account_client_tr, accountId, rootAccountId=None):
+    """Returns {region: status} for every opt-in region of an account with one paginated list_regions"""
+    kwargs = {'RegionOptStatusContains': OPT_IN_REGION_STATUSES}
+    # The management account must call the Account API without an AccountId
+    if accountId != rootAccountId:
+        kwargs['AccountId'] = accountId
+
+    # paged by hand so every page goes through the throttle controller
+    regions_status = {}
+    while True:
+        regions_paged = account_throttle.call(account_client_tr.list_regions, **kwargs)
+        for region in regions_paged['Regions']:
+            regions_status[region['RegionName']] = region['RegionOptStatus']
+        if not regions_paged.get('NextToken'):
+            return regions_status
+        kwargs['NextToken'] = regions_paged['NextToken']
+
+
+def thread_status(accountId, rootAccountId):
+    account_client_tr = get_account_client()
+
+    return get_account_regions_status(account_client_tr, accountId, rootAccountId)
+
+
+def status_matrix(all_accounts, regions=None, concurrency=15, rootAccountId=None):
+    """
+    Builds the account x opt-in region status matrix with one list_regions call per account
+    regions: only keep these regions in the matrix, all opt-in regions when None
+    Returns {accountId: {region: status}}
+    """
+    if rootAccountId is None:
+        rootAccountId = get_management_account_id()
+
+    print('Getting opt-in region status for {} accounts with {} workers'.format(
+        len(all_accounts), concurrency))
+
+    matrix = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        future_to_account = {
+            executor.submit(thread_status, accountId, rootAccountId): accountId
+            for accountId in all_accounts
+        }
+        for future in as_completed(future_to_account):
+            accountId = future_to_account[future]
+            try:
+                regions_status = future.result()
+            except Exception as e:
+                print('Error getting region status for {}: {}'.format(accountId, e))
+                continue
+            if regions is not None:
+                regions_status = {region: regions_status.get(region, 'UNKNOWN')
+                                  for region in regions}
+            matrix[accountId] = regions_status
+
+    account_throttle.print_report()
+    return matrix
+
+
+def print_status_summary(matrix):
+    summary = {}
+    for regions_status in matrix.values():
+        for region, status in regions_status.items():
+            summary.setdefault(region, {}).setdefault(status, 0)
+            summary[region][status] += 1
+
+    for region in sorted(summary):
+        counts = ', '.join('{} {}'.format(status, count)
+                           for status, count in sorted(summary[region].items()))
+        print('{}: {}'.format(region, counts))
+
+
+def write_status_matrix(matrix, output_file, output_format='csv'):
+    regions = sorted({region for regions_status in matrix.values()
+                      for region in regions_status})
+
+    with open(output_file, 'w', newline='') as f:
+        if output_format == 'json':
+            json.dump({accountId: matrix[accountId] for accountId in sorted(matrix)},
+                      f, indent=2, sort_keys=True)
+        else:
+            writer = csv.writer(f)
+            writer.writerow(['AccountId'] + regions)
+            for accountId in sorted(matrix):
+                writer.writerow([accountId] + [matrix[accountId].get(region, '')
+                                               for region in regions])
+
+    print('Status matrix for {} accounts saved to {}'.format(len(matrix), output_file))
 
 
 if __name__ == '__main__':
     parser.parse_args()
     args = parser.parse_args()
-    all_accounts = get_all_accounts_by_ou(None, [], args.IgnoreOU)
-    print ("Action: " + args.Action)
-    opt_in(args.OptInRegion, all_accounts, args.Action)
+    if args.Concurrency < 1:
+        parser.error('--Concurrency must be at least 1')
+    if args.PollBudget <= 0:
+        parser.error('--PollBudget must be greater than 0')
+    if args.PerAccountLimit < 1:
+        parser.error('--PerAccountLimit must be at least 1')
+    if args.OrgConcurrency < 1:
+        parser.error('--OrgConcurrency must be at least 1')
+    regions = None
+    if args.OptInRegion:
+        regions = [region.strip() for value in args.OptInRegion
+                   for region in value.split(',') if region.strip()]
+    action = args.Action.lower()
+    if action != 'status' and not regions:
+        parser.error('--OptInRegion is required for the {} action'.format(action))
+    account_throttle = AdaptiveThrottle(args.Concurrency)
+    # enable/disable only use a cached org snapshot when asked to, it may miss
+    # accounts created or moved since it was taken
+    org_cache_ttl = args.OrgCacheTTL
+    if org_cache_ttl is None:
+        org_cache_ttl = 3600 if action == 'status' else 0
+    snapshot = load_org_snapshot(args.OrgCache, org_cache_ttl, args.OrgConcurrency)
+    all_accounts = get_all_accounts_by_ou(snapshot, args.IgnoreOU)
+    rootAccountId = snapshot['ManagementAccountId']
+    print ("Action: " + action)
+    if action == 'status':
+        matrix = status_matrix(all_accounts, regions, args.Concurrency, rootAccountId)
+        print_status_summary(matrix)
+        if args.StatusOutput:
+            write_status_matrix(matrix, args.StatusOutput, args.StatusFormat)
+    else:
+        opt_in(regions, all_accounts, action, args.Concurrency,
+               args.CentralPoller, args.PollBudget, args.PerAccountLimit,
+               rootAccountId, args.Journal, args.Resume, args.MetricsFile)
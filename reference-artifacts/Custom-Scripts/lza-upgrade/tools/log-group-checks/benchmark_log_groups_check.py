@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Offline scale benchmark for log-groups-check.py
+
+A synthetic organization is served by in-process Organizations, STS and CloudWatch Logs
+fakes hooked into botocore's before-send event, so requests go through the real client
+serialization, signing and parsing code paths without any network access. main() is run
+once per --max-workers value, each in a fresh interpreter so peak memory is not shared.
+
+Examples:
+    python3 benchmark_log_groups_check.py --accounts 50 --max-workers 5 10 20 40
+    python3 benchmark_log_groups_check.py --accounts 500 --max-log-groups 5000 --max-workers 20 80
+    python3 benchmark_log_groups_check.py --runs 2 --extra-args="--incremental"
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+# the script creates its session at import time, make sure this never reaches
+# real credentials or endpoints
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+os.environ['AWS_ACCESS_KEY_ID'] = 'benchmark'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'benchmark'
+os.environ.pop('AWS_PROFILE', None)
+os.environ.pop('AWS_SESSION_TOKEN', None)
+
+from botocore.awsrequest import AWSResponse  # noqa: E402
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log-groups-check.py')
+BENCHMARK_REGIONS = ['ca-central-1', 'ca-west-1', 'us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2']
+ORGANIZATIONS_PAGE_SIZE = 20
+LOG_GROUPS_PAGE_SIZE = 50
+
+
+def load_script():
+    """Import log-groups-check.py, its file name is not a valid module name."""
+    spec = importlib.util.spec_from_file_location('log_groups_check', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeRawResponse:
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self, **kwargs):
+        yield self._body
+
+
+class FakeOrganization:
+    """
+    In-process stand-in for the Organizations, STS and CloudWatch Logs APIs of a synthetic org
+
+    Every account-region has between 0 and max_log_groups log groups, skewed so that most
+    account-regions are small and a few are very large. 70% of the log groups have no
+    subscription filter, 25% have one and 5% have two. Log groups and filters are derived
+    from their index, so large organizations are served without being held in memory.
+    """
+
+    def __init__(self, accounts, regions, max_log_groups, latency, seed):
+        self.account_ids = [f"{i:012d}" for i in range(1, accounts + 1)]
+        self.regions = regions
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.log_group_counts = {}
+        for account_id in self.account_ids:
+            for region in regions:
+                fraction = (zlib.crc32(f"{seed}-{account_id}-{region}".encode()) % 10000) / 10000
+                self.log_group_counts[(account_id, region)] = int(max_log_groups * fraction ** 3)
+        self._selected = {}
+
+    def register(self, session):
+        """Serve every request of clients created from session."""
+        session.events.register('before-send', self.handle)
+
+    @staticmethod
+    def log_group_name(index):
+        if index % 4 == 0:
+            return f"/aws/lambda/ASEA-function-{index:05d}"
+        return f"/app/service-{index:05d}/logs"
+
+    @staticmethod
+    def filters_count(account_id, region, index):
+        bucket = (index * 2654435761 + zlib.crc32(f"{account_id}-{region}".encode())) % 100
+        return 0 if bucket < 70 else 1 if bucket < 95 else 2
+
+    def selected_indexes(self, count, prefix, pattern):
+        """Return the indexes of the log groups matching the describe_log_groups filters."""
+        key = (count, prefix, pattern)
+        with self.lock:
+            if key not in self._selected:
+                self._selected[key] = [
+                    index for index in range(count)
+                    if (not prefix or self.log_group_name(index).startswith(prefix)) and
+                    (not pattern or pattern.lower() in self.log_group_name(index).lower())
+                ]
+            return self._selected[key]
+
+    def handle(self, request, **kwargs):
+        target = request.headers.get('X-Amz-Target')
+        if isinstance(target, bytes):
+            target = target.decode('utf-8')
+        operation = target.split('.')[-1] if target else 'AssumeRole'
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+        if operation != 'ListAccounts' and self.latency:
+            time.sleep(self.latency)
+
+        if operation == 'AssumeRole':
+            return AWSResponse(request.url, 200, {}, FakeRawResponse(self.assume_role(request.body)))
+
+        account_id, region = self.credential_scope(request)
+        params = json.loads(request.body or b'{}')
+        body = getattr(self, operation)(params, account_id, region)
+        return AWSResponse(request.url, 200, {'Content-Type': 'application/x-amz-json-1.1'},
+                           FakeRawResponse(json.dumps(body).encode('utf-8')))
+
+    @staticmethod
+    def credential_scope(request):
+        """Return the account and region of a signed request, the fake assumed role access key is the account ID."""
+        authorization = request.headers.get('Authorization', b'')
+        if isinstance(authorization, bytes):
+            authorization = authorization.decode('utf-8')
+        access_key, _, region = authorization.split('Credential=')[-1].split('/')[:3]
+        return access_key.replace('ASIA', ''), region
+
+    def assume_role(self, body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        account_id = body.split('arn%3Aaws%3Aiam%3A%3A')[-1][:12]
+        expiration = (datetime.now(timezone.utc) + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return (
+            '<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/"><AssumeRoleResult>'
+            f'<Credentials><AccessKeyId>ASIA{account_id}</AccessKeyId><SecretAccessKey>benchmark</SecretAccessKey>'
+            f'<SessionToken>benchmark</SessionToken><Expiration>{expiration}</Expiration></Credentials>'
+            f'<AssumedRoleUser><Arn>arn:aws:sts::{account_id}:assumed-role/benchmark/benchmark</Arn>'
+            '<AssumedRoleId>AROABENCHMARK:benchmark</AssumedRoleId></AssumedRoleUser>'
+            '</AssumeRoleResult></AssumeRoleResponse>'
+        ).encode('utf-8')
+
+    def ListAccounts(self, params, account_id, region):
+        start = int(params.get('NextToken') or 0)
+        end = start + ORGANIZATIONS_PAGE_SIZE
+        body = {'Accounts': [
+            {'Id': account_id, 'Name': f"Account {account_id}", 'Status': 'ACTIVE'}
+            for account_id in self.account_ids[start:end]
+        ]}
+        if end < len(self.account_ids):
+            body['NextToken'] = str(end)
+        return body
+
+    def DescribeResourcePolicies(self, params, account_id, region):
+        count = zlib.crc32(f"policies-{account_id}-{region}".encode()) % 11
+        return {'resourcePolicies': [
+            {'policyName': f"policy-{i}", 'policyDocument': '{}', 'lastUpdatedTime': 0} for i in range(count)
+        ]}
+
+    def DescribeLogGroups(self, params, account_id, region):
+        indexes = self.selected_indexes(self.log_group_counts.get((account_id, region), 0),
+                                        params.get('logGroupNamePrefix'), params.get('logGroupNamePattern'))
+        start = int(params.get('nextToken') or 0)
+        end = start + LOG_GROUPS_PAGE_SIZE
+        body = {'logGroups': []}
+        for index in indexes[start:end]:
+            name = self.log_group_name(index)
+            body['logGroups'].append({
+                'logGroupName': name,
+                'arn': f"arn:aws:logs:{region}:{account_id}:log-group:{name}:*",
+                'creationTime': 1600000000000 + index,
+                'retentionInDays': [1, 30, 365, 3653][index % 4],
+                'metricFilterCount': index % 3,
+                'storedBytes': index * 1024
+            })
+        if end < len(indexes):
+            body['nextToken'] = str(end)
+        return body
+
+    def DescribeSubscriptionFilters(self, params, account_id, region):
+        name = params['logGroupName']
+        index = int(name.split('-')[-1].split('/')[0])
+        return {'subscriptionFilters': [
+            {
+                'filterName': f"filter-{i}",
+                'logGroupName': name,
+                'filterPattern': '',
+                'destinationArn': f"arn:aws:logs:{region}:999999999999:destination:central-{i}",
+                'distribution': 'ByLogStream',
+                'creationTime': 1600000000000
+            }
+            for i in range(self.filters_count(account_id, region, index))
+        ]}
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_single(args, max_workers):
+    """Run main() args.runs times against the fake organization and return a result per run."""
+    script = load_script()
+    org = FakeOrganization(args.accounts, BENCHMARK_REGIONS[:args.regions], args.max_log_groups,
+                           args.latency_ms / 1000, args.seed)
+    org.register(script.aws_session)
+
+    results = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for run in range(1, args.runs + 1):
+            sys.argv = [
+                'log-groups-check', '--regions', *org.regions, '--max-workers', str(max_workers),
+                '-o', os.path.join(output_dir, 'results.json'),
+                '--timings-file', os.path.join(output_dir, 'timings.json'),
+                '--cache-file', os.path.join(output_dir, 'cache.sqlite'),
+                *shlex.split(args.extra_args)
+            ]
+            calls_before = org.total_calls()
+            assume_role_before = org.calls.get('AssumeRole', 0)
+
+            # the script reports progress line by line, keep it out of the results
+            start = time.monotonic()
+            with contextlib.redirect_stdout(io.StringIO()):
+                script.main()
+            elapsed = time.monotonic() - start
+
+            api_calls = org.total_calls() - calls_before
+            results.append({
+                'maxWorkers': max_workers,
+                'run': run,
+                'seconds': round(elapsed, 2),
+                'apiCalls': api_calls,
+                'callsPerSec': round(api_calls / elapsed, 1),
+                'assumeRole': org.calls.get('AssumeRole', 0) - assume_role_before,
+                'peakRssMb': round(peak_rss_mb(), 1)
+            })
+    return results
+
+
+def run_isolated(args, max_workers):
+    """Run one --max-workers value in a fresh interpreter so peak memory is not shared."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--single', str(max_workers),
+           '--accounts', str(args.accounts), '--regions', str(args.regions),
+           '--max-log-groups', str(args.max_log_groups), '--latency-ms', str(args.latency_ms),
+           '--runs', str(args.runs), '--seed', str(args.seed), f"--extra-args={args.extra_args}"]
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_table(results):
+    columns = list(results[0].keys())
+    widths = [max(len(str(c)), *(len(str(r[c])) for r in results)) for c in columns]
+    print('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline scale benchmark for log-groups-check.py against a synthetic organization')
+    parser.add_argument('--accounts', type=int, default=50,
+                        help="Number of accounts in the synthetic organization")
+    parser.add_argument('--regions', type=int, default=3, choices=range(1, len(BENCHMARK_REGIONS) + 1),
+                        help="Number of regions checked in every account")
+    parser.add_argument('--max-log-groups', type=int, default=2000,
+                        help="Largest number of log groups in an account-region")
+    parser.add_argument('--latency-ms', type=float, default=10,
+                        help="Simulated latency of every API call in milliseconds")
+    parser.add_argument('--max-workers', type=int, nargs='+', default=[5, 10, 20, 40],
+                        help="--max-workers values to benchmark")
+    parser.add_argument('--runs', type=int, default=1,
+                        help="Consecutive runs for each --max-workers value, later runs reuse the cache file")
+    parser.add_argument('--extra-args', default='',
+                        help="Extra arguments passed to log-groups-check.py, e.g. --extra-args=\"--incremental\"")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args, args.single)))
+        return
+
+    org = FakeOrganization(args.accounts, BENCHMARK_REGIONS[:args.regions], args.max_log_groups, 0, args.seed)
+    print(f"Synthetic organization: {args.accounts} accounts, {args.regions} regions, "
+          f"{sum(org.log_group_counts.values())} log groups\n")
+    print_table([result for max_workers in args.max_workers for result in run_isolated(args, max_workers)])
+
+
+if __name__ == '__main__':
+    main()
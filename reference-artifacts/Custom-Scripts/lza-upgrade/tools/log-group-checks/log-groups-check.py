@@ -1,53 +1,662 @@
 #!/usr/bin/env python3
 import argparse
 import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+import csv
+import itertools
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+from datetime import timedelta
+import hashlib
+import queue
+import re
+import sqlite3
+import sys
 import threading
+import time
 
-# Thread-local storage for progress tracking
-thread_local = threading.local()
+# Clients are thread safe but creating them is not, so every client of the
+# script is created from this session while holding client_lock
+aws_session = boto3.session.Session()
+client_lock = threading.Lock()
 
+# Log groups are spread over every worker so an account can exceed the per account
+# CloudWatch Logs TPS quotas, the adaptive retry mode backs off each client on throttling
+LOGS_CLIENT_CONFIG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
 
-def get_log_group_resource_policies_count(logs_client):
+# Columns of the inventory file, the attributes come from describe_log_groups
+INVENTORY_COLUMNS = [
+    'accountId',
+    'accountName',
+    'region',
+    'logGroupName',
+    'logGroupArn',
+    'creationTime',
+    'logGroupClass',
+    'retentionInDays',
+    'kmsKeyId',
+    'metricFilterCount',
+    'storedBytes',
+    'subscriptionFilterCount'
+]
+
+# Account-region tasks only list log groups, the subscription filters are looked up by
+# log group batch tasks which run first so large accounts are spread across all workers
+BATCH_PRIORITY = 0
+ACCOUNT_REGION_PRIORITY = 1
+
+
+def create_client(service_name, region=None, session=None, config=None):
+    """Create a client from the shared session, or from an assumed role session of CredentialCache."""
+    kwargs = {'config': config} if config else {}
+    with client_lock:
+        if session:
+            return session.create_client(service_name, region_name=region, **kwargs)
+        return aws_session.client(service_name, region_name=region, **kwargs)
+
+
+class CredentialCache:
+    """Thread-safe cache of assumed role sessions keyed by account.
+
+    The role is assumed once per account and the session is shared by every
+    region of the account. The session credentials assume the role again shortly
+    before they expire, so clients stay valid however long the scan of the account is.
+    """
+
+    def __init__(self, role_name):
+        self.role_name = role_name
+        self.assume_role_calls = 0
+        self._sts_client = create_client('sts')
+        self._lock = threading.Lock()
+        self._account_locks = {}
+        self._sessions = {}
+
+    def get(self, account_id):
+        """Return the session of the role in the account."""
+        with self._lock:
+            account_lock = self._account_locks.setdefault(account_id, threading.Lock())
+
+        # only one thread assumes the role of an account, the others wait for it
+        with account_lock:
+            session = self._sessions.get(account_id)
+            if session is None:
+                credentials = RefreshableCredentials.create_from_metadata(
+                    metadata=self._assume_role(account_id),
+                    refresh_using=lambda: self._assume_role(account_id),
+                    method='sts-assume-role'
+                )
+                # the session shares the events and loaded service models of the shared session
+                session = botocore.session.Session(event_hooks=aws_session.events, include_builtin_handlers=False)
+                session.register_component('data_loader', aws_session._session.get_component('data_loader'))
+                session._credentials = credentials
+                self._sessions[account_id] = session
+            return session
+
+    def _assume_role(self, account_id):
+        """Assume the role in the account and return the credentials in the RefreshableCredentials format."""
+        response = self._sts_client.assume_role(
+            RoleArn=f"arn:aws:iam::{account_id}:role/{self.role_name}",
+            RoleSessionName=f"LogGroupsCheck-{account_id}"
+        )
+        with self._lock:
+            self.assume_role_calls += 1
+        credentials = response['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+
+class RateLimiter:
+    """Token bucket shared by every worker to cap the global API call rate."""
+
+    def __init__(self, calls_per_second):
+        self.calls_per_second = calls_per_second
+        self._lock = threading.Lock()
+        self._next_call = time.monotonic()
+
+    def acquire(self):
+        """Wait until the next API call is allowed, does nothing without a limit."""
+        if not self.calls_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_call - now
+            self._next_call = max(self._next_call, now) + 1 / self.calls_per_second
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TwoLevelScheduler:
+    """Worker pool shared by the account-region tasks and the log group batch tasks they submit.
+
+    Tasks are picked by priority, then in submission order, so batches of an account
+    already being scanned run before the next account-region pair is started.
+    """
+
+    def __init__(self, max_workers):
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._workers = [threading.Thread(target=self._run, daemon=True) for _ in range(max_workers)]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, priority, fn, *args):
+        self._queue.put((priority, next(self._sequence), fn, args))
+
+    def _run(self):
+        while True:
+            _, _, fn, args = self._queue.get()
+            if fn is None:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Unexpected error in worker: {e}")
+
+    def shutdown(self):
+        """Stop the workers once the queued tasks are done."""
+        for _ in self._workers:
+            self._queue.put((ACCOUNT_REGION_PRIORITY + 1, next(self._sequence), None, ()))
+        for worker in self._workers:
+            worker.join()
+
+
+def get_log_group_resource_policies_count(logs_client, rate_limiter):
     """Get count of log group resource policies."""
     try:
-        response = logs_client.describe_resource_policies()
-        return len(response.get('resourcePolicies', []))
+        count = 0
+        kwargs = {}
+        while True:
+            rate_limiter.acquire()
+            response = logs_client.describe_resource_policies(**kwargs)
+            count += len(response.get('resourcePolicies', []))
+            if not response.get('nextToken'):
+                return count
+            kwargs['nextToken'] = response['nextToken']
     except Exception as e:
         print(f"Error getting resource policies: {e}")
         return 0
 
 
-def get_log_groups_filters(logs_client):
-    """Fetch all log groups and return the subscription filters."""
-    paginator = logs_client.get_paginator('describe_log_groups')
+def get_log_group_selectors(prefixes=None, pattern=None):
+    """Return the describe_log_groups filters selecting the log groups to check."""
+    if prefixes:
+        return [{'logGroupNamePrefix': prefix} for prefix in prefixes]
+    if pattern:
+        return [{'logGroupNamePattern': pattern}]
+    return [{}]
+
+
+def get_log_group_pages(logs_client, rate_limiter, selectors):
+    """Yield the log groups matching any of the selectors one page at a time."""
+    seen = set()
+    for selector in selectors:
+        kwargs = dict(selector)
+        while True:
+            rate_limiter.acquire()
+            page = logs_client.describe_log_groups(**kwargs)
+
+            # overlapping prefixes return the same log groups more than once
+            log_groups = [log_group for log_group in page['logGroups'] if log_group['logGroupName'] not in seen]
+            seen.update(log_group['logGroupName'] for log_group in log_groups)
+            yield log_groups
+
+            if not page.get('nextToken'):
+                break
+            kwargs['nextToken'] = page['nextToken']
+
+
+def get_log_groups_filters(logs_client, log_groups, rate_limiter):
+    """Return the subscription filters of a batch of log groups."""
     log_groups_with_two_filters = []
 
-    for page in paginator.paginate():
-        for log_group in page['logGroups']:
-            log_group_name = log_group['logGroupName']
+    for log_group in log_groups:
+        log_group_name = log_group['logGroupName']
+        try:
+            rate_limiter.acquire()
+            response = logs_client.describe_subscription_filters(
+                logGroupName=log_group_name
+            )
 
-            try:
-                response = logs_client.describe_subscription_filters(
-                    logGroupName=log_group_name
-                )
+            log_groups_with_two_filters.append({
+                'logGroupName': log_group_name,
+                'filters': response['subscriptionFilters']
+            })
+
+        except Exception as e:
+            print(f"Error getting filters for {log_group_name}: {e}")
+
+    return log_groups_with_two_filters
+
+
+class FiltersCache:
+    """SQLite cache of the subscription filters last seen on each log group.
+
+    Entries are keyed by account, region and log group ARN. An entry is only used if the
+    log group still has the same creation time and the entry is not older than the TTL.
+    """
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS subscription_filters ('
+                'account_id TEXT, region TEXT, log_group_arn TEXT, creation_time INTEGER, '
+                'filters TEXT, scanned_at REAL, PRIMARY KEY (account_id, region, log_group_arn))'
+            )
+            # expired entries are never used again
+            self._connection.execute('DELETE FROM subscription_filters WHERE scanned_at < ?', (time.time() - ttl,))
+
+    def get_many(self, account_id, region, log_groups):
+        """Return the cached filters of the log groups that are still valid, keyed by log group ARN."""
+        oldest = time.time() - self.ttl
+        cached = {}
+        with self._lock:
+            for log_group in log_groups:
+                row = self._connection.execute(
+                    'SELECT creation_time, filters, scanned_at FROM subscription_filters '
+                    'WHERE account_id = ? AND region = ? AND log_group_arn = ?',
+                    (account_id, region, log_group['arn'])
+                ).fetchone()
+                if row and row[0] == log_group.get('creationTime') and row[2] >= oldest:
+                    cached[log_group['arn']] = json.loads(row[1])
+            self.hits += len(cached)
+            self.misses += len(log_groups) - len(cached)
+        return cached
+
+    def put_many(self, account_id, region, entries):
+        """Store the filters of a list of (log group, filters) tuples."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO subscription_filters VALUES (?, ?, ?, ?, ?, ?)',
+                [(account_id, region, log_group['arn'], log_group.get('creationTime'), json.dumps(filters), now)
+                 for log_group, filters in entries]
+            )
+
+    def invalidate(self, account_id, region, log_group_names):
+        """Delete the entries of the log groups, their filters are queried again by the next incremental run."""
+        with self._lock, self._connection:
+            # describe_log_groups ARNs end with :log-group:<name>:*
+            self._connection.executemany(
+                'DELETE FROM subscription_filters WHERE account_id = ? AND region = ? '
+                'AND substr(log_group_arn, -length(?)) = ?',
+                [(account_id, region, suffix, suffix)
+                 for suffix in (f":log-group:{name}:*" for name in log_group_names)]
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+class ResultWriter:
+    """Write each account-region result to the output file as soon as it completes.
+
+    The json format streams a single JSON array. The jsonl format writes one result
+    per line and flushes it, so the results of an interrupted run are kept.
+    """
+
+    def __init__(self, path, output_format):
+        self.output_format = output_format
+        self.count = 0
+        self._file = open(path, 'w')
+        if output_format == 'json':
+            self._file.write('[')
+
+    def write(self, result):
+        if self.output_format == 'jsonl':
+            self._file.write(json.dumps(result) + '\n')
+            self._file.flush()
+        else:
+            separator = ',\n' if self.count else '\n'
+            self._file.write(separator + json.dumps(result, indent=2))
+        self.count += 1
+
+    def close(self):
+        if self.output_format == 'json':
+            self._file.write('\n]\n' if self.count else ']\n')
+        self._file.close()
+
+
+class InventoryWriter:
+    """Write the attributes of every checked log group to a CSV file with the INVENTORY_COLUMNS.
+
+    Rows are written by the batch tasks as soon as they complete. Missing attributes,
+    such as the KMS key of a log group that is not encrypted, are left empty.
+    """
+
+    def __init__(self, path):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(INVENTORY_COLUMNS)
+
+    def write(self, account, region, log_groups, filters_by_name):
+        rows = []
+        for log_group in log_groups:
+            filters = filters_by_name.get(log_group['logGroupName'])
+            values = {
+                'accountId': account['Id'],
+                'accountName': account['Name'],
+                'region': region,
+                # arn ends with :*, logGroupArn is only missing from older API responses
+                'logGroupArn': log_group.get('logGroupArn', log_group.get('arn')),
+                'subscriptionFilterCount': len(filters) if filters is not None else None
+            }
+            rows.append([
+                values[column] if column in values else log_group.get(column)
+                for column in INVENTORY_COLUMNS
+            ])
+
+        with self._lock:
+            self._writer.writerows(rows)
+            self.count += len(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ResultAggregator:
+    """Running totals of the results for the final report.
+
+    Only the account-regions that are reported in detail are kept, with only
+    their log groups that have 2 or more subscription filters.
+    """
+
+    def __init__(self):
+        self.results_count = 0
+        self.total_log_groups = 0
+        self.total_resource_policies = 0
+        self.reported_results = []
+
+    def add(self, result):
+        self.results_count += 1
+        self.total_log_groups += len(result['logGroups'])
+        self.total_resource_policies += result['resourcePoliciesCount']
+
+        if result['logGroupsWithTwoFiltersCount'] > 0 or result['resourcePoliciesCount'] > 8:
+            reported_result = dict(result)
+            reported_result['logGroups'] = [lg for lg in result['logGroups'] if len(lg['filters']) >= 2]
+            self.reported_results.append(reported_result)
+
+    def print_report(self):
+        print(f"\nFinal Report: {self.total_log_groups} log groups across {self.results_count} account-region combinations")
+        print(f"Total resource policies: {self.total_resource_policies}")
+        print("=" * 80)
+
+        for result in self.reported_results:
+            print(f"\nAccount: {result['accountName']} ({result['accountId']}) - Region: {result['region']}")
+            print(f"Resource policies: {result['resourcePoliciesCount']}")
+            print(f"Log Groups with 2 filters: {result['logGroupsWithTwoFiltersCount']}")
+
+            for lg in result['logGroups']:
+                print(f"  • {lg['logGroupName']}")
+                for i, filter_info in enumerate(lg['filters'], 1):
+                    print(f"    Filter {i}: {filter_info['filterName']} -> {filter_info['destinationArn']}")
+
+
+class ProgressTracker:
+    """Progress of the run and wall time of every account-region scan.
 
-                log_groups_with_two_filters.append({
-                    'logGroupName': log_group_name,
-                    'filters': response['subscriptionFilters']
+    A background thread prints the completed account-regions, the log groups
+    checked per second, an ETA and the slowest account-regions still in flight.
+    """
+
+    def __init__(self, total_pairs, interval):
+        self.total_pairs = total_pairs
+        self.interval = interval
+        self.completed_pairs = 0
+        self.log_groups_checked = 0
+        self.timings = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._start = time.monotonic()
+        self._thread.start()
+
+    def started(self, scan):
+        with self._lock:
+            self._in_flight[scan] = time.monotonic()
+
+    def checked(self, log_groups_count):
+        with self._lock:
+            self.log_groups_checked += log_groups_count
+
+    def completed(self, scan, log_groups_count):
+        with self._lock:
+            wall_time = time.monotonic() - self._in_flight.pop(scan)
+            self.completed_pairs += 1
+            timing = self.timings.setdefault(scan.account['Id'], {
+                'accountId': scan.account['Id'],
+                'accountName': scan.account['Name'],
+                'wallTimeSeconds': 0,
+                'logGroups': 0,
+                'regions': {}
+            })
+            timing['wallTimeSeconds'] = round(timing['wallTimeSeconds'] + wall_time, 3)
+            timing['logGroups'] += log_groups_count
+            timing['regions'][scan.region] = round(wall_time, 3)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.print_progress()
+
+    def print_progress(self):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._start
+            completed = self.completed_pairs
+            rate = self.log_groups_checked / elapsed if elapsed else 0
+            slowest = sorted(self._in_flight.items(), key=lambda item: item[1])[:3]
+
+        eta = 'unknown'
+        if completed:
+            eta = str(timedelta(seconds=round(elapsed / completed * (self.total_pairs - completed))))
+        print(f"Progress: {completed}/{self.total_pairs} account-regions, "
+              f"{self.log_groups_checked} log groups checked ({rate:.1f}/s), ETA {eta}")
+        if slowest:
+            print("  Slowest in flight: " + ', '.join(
+                f"{scan.label} {now - started:.0f}s" for scan, started in slowest))
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def slowest_accounts(self, top_n):
+        """Return the timings of the top_n accounts with the longest total wall time."""
+        return sorted(self.timings.values(), key=lambda timing: timing['wallTimeSeconds'], reverse=True)[:top_n]
+
+
+def build_remediation_plan(results, remove_filter_pattern, replacement_destination_arn=None,
+                           replacement_role_arn=None):
+    """Return the actions removing the filters matching the pattern from log groups with 2 or more filters.
+
+    A filter matches if its name or destination ARN matches the pattern. Matching filters are
+    deleted, or replaced by the same filter sending to the replacement destination if one is given.
+    A log group always keeps at least one filter, when every filter of a log group matches and no
+    replacement destination is given, a single 'skip' action is planned for the log group instead.
+    """
+    pattern = re.compile(remove_filter_pattern)
+    plan = []
+    for result in results:
+        for lg in result['logGroups']:
+            if len(lg['filters']) < 2:
+                continue
+            matching = [
+                filter_info for filter_info in lg['filters']
+                if pattern.search(filter_info['filterName']) or pattern.search(filter_info['destinationArn'])
+            ]
+            if not replacement_destination_arn and len(matching) == len(lg['filters']):
+                plan.append({
+                    'accountId': result['accountId'],
+                    'accountName': result['accountName'],
+                    'region': result['region'],
+                    'logGroupName': lg['logGroupName'],
+                    'action': 'skip',
+                    'filters': matching,
+                    'status': 'skipped: every filter matches the pattern, deleting them would leave no filter'
                 })
+                continue
+            for filter_info in matching:
+                action = {
+                    'accountId': result['accountId'],
+                    'accountName': result['accountName'],
+                    'region': result['region'],
+                    'logGroupName': lg['logGroupName'],
+                    'action': 'replace' if replacement_destination_arn else 'delete',
+                    'filter': filter_info
+                }
+                if replacement_destination_arn:
+                    replacement = {
+                        key: filter_info[key]
+                        for key in ('filterName', 'filterPattern', 'roleArn', 'distribution') if key in filter_info
+                    }
+                    replacement['destinationArn'] = replacement_destination_arn
+                    if replacement_role_arn:
+                        replacement['roleArn'] = replacement_role_arn
+                    action['replacement'] = replacement
+                plan.append(action)
+    return plan
 
-            except Exception as e:
-                print(f"Error getting filters for {log_group_name}: {e}")
 
-    return log_groups_with_two_filters
+def print_remediation_plan(plan):
+    skipped = [action for action in plan if action['action'] == 'skip']
+    actions = [action for action in plan if action['action'] != 'skip']
+    deletes = sum(1 for action in actions if action['action'] == 'delete')
+    log_groups = {(action['accountId'], action['region'], action['logGroupName']) for action in actions}
+    print(f"\nRemediation plan: {deletes} filters to delete and {len(actions) - deletes} filters to replace "
+          f"across {len(log_groups)} log groups")
+    print("=" * 80)
+
+    for action in actions:
+        filter_info = action['filter']
+        line = (f"  {action['accountName']} ({action['accountId']}) {action['region']} {action['logGroupName']}: "
+                f"{action['action']} {filter_info['filterName']} -> {filter_info['destinationArn']}")
+        if action['action'] == 'replace':
+            line += f" with -> {action['replacement']['destinationArn']}"
+        print(line)
+
+    if skipped:
+        print(f"\nWARNING: {len(skipped)} log groups skipped, every filter matches the pattern and "
+              f"deleting them all would stop the log forwarding. Use a narrower --remove-filter-pattern:")
+        for action in skipped:
+            names = ', '.join(filter_info['filterName'] for filter_info in action['filters'])
+            print(f"  {action['accountName']} ({action['accountId']}) {action['region']} {action['logGroupName']}: "
+                  f"{names}")
+
+
+def apply_remediation_batch(context, actions):
+    """Apply a batch of remediation actions of a single account-region and record their status."""
+    try:
+        logs_client = get_logs_client(context.credential_cache, actions[0]['accountId'], actions[0]['region'])
+    except Exception as e:
+        for action in actions:
+            action['status'] = f"failed: {e}"
+        return
+
+    for action in actions:
+        # a put with the name of the existing filter updates it in place, the log group
+        # never loses the filter if the replacement fails
+        step = 'put_subscription_filter' if action['action'] == 'replace' else 'delete_subscription_filter'
+        try:
+            context.rate_limiter.acquire()
+            if action['action'] == 'replace':
+                logs_client.put_subscription_filter(logGroupName=action['logGroupName'], **action['replacement'])
+            else:
+                logs_client.delete_subscription_filter(
+                    logGroupName=action['logGroupName'],
+                    filterName=action['filter']['filterName']
+                )
+            action['status'] = 'applied'
+        except Exception as e:
+            action['status'] = f"failed: {e}"
+            action['failedStep'] = step
+            print(f"  {action['accountName']} ({action['region']}) {action['logGroupName']}: "
+                  f"Failed to {action['action']} {action['filter']['filterName']} - {e}")
+
+
+def apply_remediation_plan(plan, context):
+    """Apply the plan in batches of the same account-region on the scan workers."""
+    pairs = {}
+    for action in plan:
+        if action['action'] == 'skip':
+            continue
+        pairs.setdefault((action['accountId'], action['region']), []).append(action)
+
+    done = queue.Queue()
+
+    def run_batch(actions):
+        try:
+            apply_remediation_batch(context, actions)
+        finally:
+            done.put(len(actions))
+
+    batches = 0
+    for actions in pairs.values():
+        for i in range(0, len(actions), context.batch_size):
+            context.scheduler.submit(BATCH_PRIORITY, run_batch, actions[i:i + context.batch_size])
+            batches += 1
+
+    applied = 0
+    for _ in range(batches):
+        applied += done.get()
+        print(f"Remediation progress: {applied}/{sum(len(actions) for actions in pairs.values())} actions")
+
+
+def read_results(path):
+    """Yield the account-region results of a JSON or JSON Lines output file."""
+    with open(path) as f:
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+        f.seek(0)
+
+        if first_char == '[':
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_shard(value):
+    """Parse a shard given as i/N where 1 <= i <= N."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected i/N")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', i must be between 1 and N")
+    return index, count
+
+
+def get_account_shard(account_id, shard_count):
+    """Return the 1-based shard of an account, stable across processes and hosts."""
+    digest = hashlib.sha256(account_id.encode()).hexdigest()
+    return int(digest, 16) % shard_count + 1
 
 
 def get_active_accounts():
     """Get all active accounts from AWS Organizations."""
     print("Fetching active accounts from AWS Organizations...")
-    org_client = boto3.client('organizations')
+    org_client = create_client('organizations')
     paginator = org_client.get_paginator('list_accounts')
 
     active_accounts = []
@@ -63,64 +672,194 @@ def get_active_accounts():
     return active_accounts
 
 
-def assume_role_and_get_logs_client(account_id, role_name, region):
-    """Assume role in target account and return logs client."""
-    sts_client = boto3.client('sts')
+def get_logs_client(credential_cache, account_id, region):
+    """Return a logs client for the account and region using the cached role session."""
+    return create_client('logs', region, credential_cache.get(account_id), LOGS_CLIENT_CONFIG)
 
-    role_arn = f"arn:aws:iam::{account_id}:role/{role_name}"
-    response = sts_client.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName=f"LogGroupsCheck-{account_id}"
-    )
 
-    credentials = response['Credentials']
-    return boto3.client(
-        'logs',
-        region_name=region,
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken']
-    )
+class ScanContext:
+    """Settings and shared helpers of the account-region scans of a run."""
 
+    def __init__(self, credential_cache, scheduler, rate_limiter, progress, batch_size, selectors,
+                 filters_cache=None, inventory=None):
+        self.credential_cache = credential_cache
+        self.scheduler = scheduler
+        self.rate_limiter = rate_limiter
+        self.progress = progress
+        self.batch_size = batch_size
+        self.selectors = selectors
+        self.filters_cache = filters_cache
+        self.inventory = inventory
 
-def process_account(account, role_name, region):
-    """Process a single account in a specific region and return results."""
-    account_id = account['Id']
-    account_name = account['Name']
 
-    print(f"Processing: {account_name} ({account_id}) in {region}")
+class AccountRegionScan:
+    """Scan of a single account in a specific region.
 
-    try:
-        logs_client = assume_role_and_get_logs_client(account_id, role_name, region)
-        print(f"  {account_name} ({region}): Assumed role successfully, checking log groups...")
+    The account-region task lists the log groups and submits a batch task for every
+    batch_size log groups. The last task to finish builds the result and passes it
+    to on_complete, or None if the account-region could not be processed.
+    """
+
+    def __init__(self, account, region, context, on_complete):
+        self.account = account
+        self.region = region
+        self.context = context
+        self.on_complete = on_complete
+        self.logs_client = None
+        self.resource_policies_count = 0
+        self.batches = []
+        # the listing of the log groups counts as a pending task until it is done
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    @property
+    def label(self):
+        return f"{self.account['Name']} ({self.region})"
+
+    def run(self):
+        self.context.progress.started(self)
+        print(f"Processing: {self.account['Name']} ({self.account['Id']}) in {self.region}")
+
+        try:
+            context = self.context
+            self.logs_client = get_logs_client(context.credential_cache, self.account['Id'], self.region)
+            print(f"  {self.label}: Assumed role successfully, checking log groups...")
+
+            self.resource_policies_count = get_log_group_resource_policies_count(self.logs_client,
+                                                                                 context.rate_limiter)
+            for page in get_log_group_pages(self.logs_client, context.rate_limiter, context.selectors):
+                for i in range(0, len(page), context.batch_size):
+                    self._submit_batch(page[i:i + context.batch_size])
+
+        except Exception as e:
+            print(f"  {self.label}: Error - {e}")
+            self.context.progress.completed(self, 0)
+            self.on_complete(None)
+            return
+
+        self._task_done()
+
+    def _submit_batch(self, log_groups):
+        with self._lock:
+            index = len(self.batches)
+            self.batches.append([])
+            self._pending += 1
+        self.context.scheduler.submit(BATCH_PRIORITY, self._run_batch, index, log_groups)
 
-        log_groups = get_log_groups_filters(logs_client)
-        resource_policies_count = get_log_group_resource_policies_count(logs_client)
+    def _run_batch(self, index, log_groups):
+        try:
+            filters_by_name = self._get_filters(log_groups)
+            self.batches[index] = [
+                {'logGroupName': log_group['logGroupName'], 'filters': filters_by_name[log_group['logGroupName']]}
+                for log_group in log_groups if log_group['logGroupName'] in filters_by_name
+            ]
+            if self.context.inventory:
+                self.context.inventory.write(self.account, self.region, log_groups, filters_by_name)
+        finally:
+            self.context.progress.checked(len(log_groups))
+            self._task_done()
+
+    def _get_filters(self, log_groups):
+        """Return the subscription filters of a batch of log groups keyed by log group name."""
+        filters_cache = self.context.filters_cache
+        if not filters_cache:
+            return {
+                log_group['logGroupName']: log_group['filters']
+                for log_group in get_log_groups_filters(self.logs_client, log_groups, self.context.rate_limiter)
+            }
+
+        # only the log groups that are new or whose cached entry expired are queried
+        cached = filters_cache.get_many(self.account['Id'], self.region, log_groups)
+        missing = [log_group for log_group in log_groups if log_group['arn'] not in cached]
+        filters_by_name = {
+            log_group['logGroupName']: log_group['filters']
+            for log_group in get_log_groups_filters(self.logs_client, missing, self.context.rate_limiter)
+        }
+        filters_cache.put_many(self.account['Id'], self.region, [
+            (log_group, filters_by_name[log_group['logGroupName']])
+            for log_group in missing if log_group['logGroupName'] in filters_by_name
+        ])
+
+        for log_group in log_groups:
+            if log_group['arn'] in cached:
+                filters_by_name[log_group['logGroupName']] = cached[log_group['arn']]
+        return filters_by_name
+
+    def _task_done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending:
+                return
+        result = self._build_result()
+        self.context.progress.completed(self, len(result['logGroups']))
+        self.on_complete(result)
+
+    def _build_result(self):
+        log_groups = [log_group for batch in self.batches for log_group in batch]
 
         # count log groups that have two subscription filters
         log_groups_with_two_filters_count = sum(1 for log_group in log_groups if len(log_group['filters']) == 2)
 
-        print(f"  {account_name} ({region}): Found {log_groups_with_two_filters_count} log groups with 2 subscription filters")
-        print(f"  {account_name} ({region}): Found {resource_policies_count} log group resource policies")
+        print(f"  {self.label}: Found {log_groups_with_two_filters_count} log groups with 2 subscription filters")
+        print(f"  {self.label}: Found {self.resource_policies_count} log group resource policies")
 
         return {
-            'accountId': account_id,
-            'accountName': account_name,
-            'region': region,
-            'resourcePoliciesCount': resource_policies_count,
+            'accountId': self.account['Id'],
+            'accountName': self.account['Name'],
+            'region': self.region,
+            'resourcePoliciesCount': self.resource_policies_count,
             'logGroupsWithTwoFiltersCount': log_groups_with_two_filters_count,
             'logGroups': log_groups
         }
 
-    except Exception as e:
-        print(f"  {account_name} ({region}): Error - {e}")
-        return None
+
+def merge(argv):
+    """Combine the output files of several shards into a single output file and final report."""
+    parser = argparse.ArgumentParser(
+        prog='log-groups-check merge',
+        usage='%(prog)s [options] files [files ...]',
+        description='Merge the results of log-groups-check shards and print the final report'
+    )
+    parser.add_argument('files', nargs='+',
+                        help="JSON or JSON Lines output files of the shards")
+    parser.add_argument('-o', '--output-file',
+                        help="Merged output file path (default: log-groups-results.json or log-groups-results.jsonl)")
+    parser.add_argument('--format', choices=['json', 'jsonl'], default='json',
+                        help="Merged output file format")
+
+    args = parser.parse_args(argv)
+    output_file = args.output_file if args.output_file else f"log-groups-results.{args.format}"
+
+    writer = ResultWriter(output_file, args.format)
+    aggregator = ResultAggregator()
+    seen = set()
+    try:
+        for path in args.files:
+            print(f"Reading results from {path}")
+            for result in read_results(path):
+                key = (result['accountId'], result['region'])
+                if key in seen:
+                    print(f"  Skipping duplicate result for {result['accountName']} ({result['region']})")
+                    continue
+                seen.add(key)
+                writer.write(result)
+                aggregator.add(result)
+    finally:
+        writer.close()
+
+    print(f"\nMerged {len(args.files)} files")
+    print(f"Results saved to: {output_file}")
+    aggregator.print_report()
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
         prog='log-groups-check',
-        usage='%(prog)s [options]',
+        usage='%(prog)s [options]\n       %(prog)s merge [options] files [files ...]',
         description='Check for log groups with exactly 2 subscription filters across AWS accounts'
     )
     parser.add_argument('-r', '--role-to-assume',
@@ -131,65 +870,164 @@ def main():
                         default=['ca-central-1'], help="AWS regions to check")
     parser.add_argument('--max-workers', type=int, default=10,
                         help="Maximum number of parallel workers")
-    parser.add_argument('-o', '--output-file', default='log-groups-results.json',
-                        help="Output JSON file path")
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help="Number of log groups whose subscription filters are looked up by a single task")
+    parser.add_argument('--max-api-rate', type=float, default=0,
+                        help="Maximum number of CloudWatch Logs API calls per second across all workers (0 for no limit)")
+    log_group_filter = parser.add_mutually_exclusive_group()
+    log_group_filter.add_argument('--log-group-prefix', nargs='+',
+                                  help="Only check log groups whose name starts with one of these prefixes")
+    log_group_filter.add_argument('--log-group-pattern',
+                                  help="Only check log groups whose name contains this string")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Reuse the subscription filters cached by previous runs and only query new log groups")
+    parser.add_argument('--cache-file', default='log-groups-cache.sqlite',
+                        help="SQLite file caching the subscription filters for incremental runs")
+    parser.add_argument('--cache-ttl', type=float, default=24,
+                        help="Hours after which a cached log group is queried again in incremental runs")
+    parser.add_argument('--progress-interval', type=float, default=30,
+                        help="Seconds between progress reports")
+    parser.add_argument('--timings-file',
+                        help="Output JSON file with the accounts that took the longest to check "
+                             "(default: log-groups-timings.json)")
+    parser.add_argument('--top-n', type=int, default=20,
+                        help="Number of accounts in the timings file")
+    parser.add_argument('--inventory-file',
+                        help="Also write the retention, KMS key, metric filter count and stored bytes "
+                             "of every log group to this CSV file")
+    parser.add_argument('-o', '--output-file',
+                        help="Output file path (default: log-groups-results.json or log-groups-results.jsonl)")
+    parser.add_argument('--format', choices=['json', 'jsonl'], default='json',
+                        help="Output file format, jsonl writes one account-region result per line")
+    parser.add_argument('--remediate', action='store_true',
+                        help="Build a plan removing the filters matching --remove-filter-pattern from log groups with 2 filters")
+    parser.add_argument('--remove-filter-pattern',
+                        help="Regular expression matched against the name and destination ARN of the filters to remove")
+    parser.add_argument('--replacement-destination-arn',
+                        help="Recreate the removed filters with this destination instead of only deleting them")
+    parser.add_argument('--replacement-role-arn',
+                        help="Role used by the recreated filters (default: the role of the removed filter)")
+    parser.add_argument('--plan-file', default='log-groups-remediation-plan.json',
+                        help="Output JSON file with the remediation plan and the status of each action")
+    parser.add_argument('--apply', action='store_true',
+                        help="Apply the remediation plan, without it the plan is only a dry run")
+    parser.add_argument('--shard', type=parse_shard,
+                        help="Only check the accounts of shard i out of N (i/N), use the merge command to combine the shards")
 
     args = parser.parse_args()
+    if args.max_workers < 1:
+        parser.error("--max-workers must be at least 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.remediate and not args.remove_filter_pattern:
+        parser.error("--remediate requires --remove-filter-pattern")
+    if args.apply and not args.remediate:
+        parser.error("--apply requires --remediate")
+    if args.apply and args.incremental:
+        parser.error("--apply can't be used with --incremental, the plan must be built from the current filters")
 
     role_name = args.role_to_assume if args.role_to_assume else f"{args.accel_prefix}-PipelineRole"
     regions = args.regions
     max_workers = args.max_workers
+    # the default file names of each shard are different so that shards can share a directory
+    suffix = f"-{args.shard[0]}-of-{args.shard[1]}" if args.shard else ''
+    output_file = args.output_file if args.output_file else f"log-groups-results{suffix}.{args.format}"
+    timings_file = args.timings_file if args.timings_file else f"log-groups-timings{suffix}.json"
 
     accounts = get_active_accounts()
-    all_results = []
+    if args.shard:
+        shard_index, shard_count = args.shard
+        accounts = [account for account in accounts if get_account_shard(account['Id'], shard_count) == shard_index]
+        print(f"Shard {shard_index}/{shard_count}: checking {len(accounts)} accounts")
+
+    credential_cache = CredentialCache(role_name)
+    rate_limiter = RateLimiter(args.max_api_rate)
+    selectors = get_log_group_selectors(args.log_group_prefix, args.log_group_pattern)
+    filters_cache = FiltersCache(args.cache_file, args.cache_ttl * 3600) if args.incremental else None
+    inventory = InventoryWriter(args.inventory_file) if args.inventory_file else None
 
     # Create account-region combinations
     account_region_pairs = [(account, region) for account in accounts for region in regions]
 
+    if args.log_group_prefix:
+        print(f"Only checking log groups with prefix: {', '.join(args.log_group_prefix)}")
+    elif args.log_group_pattern:
+        print(f"Only checking log groups matching: {args.log_group_pattern}")
+
     print(f"\nProcessing {len(accounts)} accounts across {len(regions)} regions ({len(account_region_pairs)} total combinations) with {max_workers} parallel workers...")
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all account-region processing tasks
-        future_to_pair = {
-            executor.submit(process_account, account, role_name, region): (account, region)
-            for account, region in account_region_pairs
-        }
+    # Both the account-region tasks and the log group batch tasks run on the same workers
+    scheduler = TwoLevelScheduler(max_workers)
+    progress = ProgressTracker(len(account_region_pairs), args.progress_interval)
+    context = ScanContext(credential_cache, scheduler, rate_limiter, progress, args.batch_size, selectors,
+                          filters_cache, inventory)
+    results = queue.Queue()
+    for account, region in account_region_pairs:
+        scan = AccountRegionScan(account, region, context, results.put)
+        scheduler.submit(ACCOUNT_REGION_PRIORITY, scan.run)
+    scheduler.start()
+    progress.start()
 
-        # Collect results as they complete
-        for future in as_completed(future_to_pair):
-            try:
-                result = future.result()
-            except Exception as e:
-                account, region = future_to_pair[future]
-                print(f"  {account['Name']} ({region}): Failed to process - {e}")
-                result = None
+    # Write results as they complete and only keep the totals for the final report
+    writer = ResultWriter(output_file, args.format)
+    aggregator = ResultAggregator()
+    try:
+        for _ in account_region_pairs:
+            result = results.get()
             if result:
-                all_results.append(result)
+                writer.write(result)
+                aggregator.add(result)
+    finally:
+        writer.close()
+        if inventory:
+            inventory.close()
+    progress.stop()
+    progress.print_progress()
 
-    # Save results to JSON file
-    with open(args.output_file, 'w') as f:
-        json.dump(all_results, f, indent=2)
+    with open(timings_file, 'w') as f:
+        json.dump(progress.slowest_accounts(args.top_n), f, indent=2)
 
-    # Final report
-    total_log_groups = sum(len(result['logGroups']) for result in all_results)
-    total_resource_policies = sum(result['resourcePoliciesCount'] for result in all_results)
     print("\nProcessing complete!")
-    print(f"Results saved to: {args.output_file}")
-    print(f"\nFinal Report: {total_log_groups} log groups across {len(all_results)} account-region combinations")
-    print(f"Total resource policies: {total_resource_policies}")
-    print("=" * 80)
+    print(f"Results saved to: {output_file}")
+    print(f"Timings of the {args.top_n} slowest accounts saved to: {timings_file}")
+    if inventory:
+        print(f"Inventory of {inventory.count} log groups saved to: {args.inventory_file}")
+    print(f"STS AssumeRole calls: {credential_cache.assume_role_calls}")
+    if filters_cache:
+        filters_cache.close()
+        print(f"Log groups served from cache: {filters_cache.hits} of {filters_cache.hits + filters_cache.misses}")
+    aggregator.print_report()
 
-    for result in all_results:
-        if result['logGroupsWithTwoFiltersCount'] > 0 or result['resourcePoliciesCount'] > 8:
-            print(f"\nAccount: {result['accountName']} ({result['accountId']}) - Region: {result['region']}")
-            print(f"Resource policies: {result['resourcePoliciesCount']}")
-            print(f"Log Groups with 2 filters: {result['logGroupsWithTwoFiltersCount']}")
+    if args.remediate:
+        # the aggregator keeps every log group with 2 or more filters, which are the only candidates
+        plan = build_remediation_plan(aggregator.reported_results, args.remove_filter_pattern,
+                                      args.replacement_destination_arn, args.replacement_role_arn)
+        print_remediation_plan(plan)
 
-            for lg in result['logGroups']:
-                if len(lg['filters']) >= 2:
-                    print(f"  • {lg['logGroupName']}")
-                    for i, filter_info in enumerate(lg['filters'], 1):
-                        print(f"    Filter {i}: {filter_info['filterName']} -> {filter_info['destinationArn']}")
+        actions = [action for action in plan if action['action'] != 'skip']
+        if args.apply and actions:
+            print(f"\nApplying remediation plan with {max_workers} parallel workers...")
+            apply_remediation_plan(plan, context)
+            failed = sum(1 for action in actions if action['status'] != 'applied')
+            print(f"Remediation complete: {len(actions) - failed} actions applied, {failed} failed, "
+                  f"{len(plan) - len(actions)} log groups skipped")
+            if os.path.exists(args.cache_file):
+                # the cached filters of the log groups the plan touched are stale
+                touched = {}
+                for action in actions:
+                    touched.setdefault((action['accountId'], action['region']), set()).add(action['logGroupName'])
+                stale_cache = FiltersCache(args.cache_file, args.cache_ttl * 3600)
+                for (account_id, region), log_group_names in touched.items():
+                    stale_cache.invalidate(account_id, region, log_group_names)
+                stale_cache.close()
+        elif not args.apply:
+            print("\nDry run, no changes were made. Rerun with --apply to apply the plan.")
+
+        with open(args.plan_file, 'w') as f:
+            json.dump(plan, f, indent=2)
+        print(f"Remediation plan saved to: {args.plan_file}")
+
+    scheduler.shutdown()
 
 
 if __name__ == "__main__":
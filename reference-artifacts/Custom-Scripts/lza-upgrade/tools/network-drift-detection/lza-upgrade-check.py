@@ -3,8 +3,12 @@ import json
 import logging
 import os
 import re
-from datetime import datetime
-from typing import Dict, List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import Dict, List, Mapping
 
 import boto3
 from botocore.exceptions import ClientError
@@ -14,23 +18,64 @@ if "LOGLEVEL" in os.environ:
         "LOGLEVEL", "WARNING"), format='%(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 
+# Creating clients is not thread safe, accounts are inventoried in parallel so
+# clients are created one at a time. The EC2 clients of every account are created
+# from ec2_session with the account credentials, so they share its loaded service models
+client_lock = threading.Lock()
+ec2_session = boto3.session.Session()
 
-def get_ec2_client(account_key, account_list, assume_role, region):
-    """
-    Returns an EC2 client with appropriate credentials for account
-    account_key: account key from ASEA config
-    assume_role: name of role to assume
-    region: AWS region to connect to
+# Number of accounts/{index} keys requested by the first BatchGetItem call, the
+# window doubles on each call up to the BatchGetItem limit of 100 keys
+ACCOUNTS_KEY_WINDOW = 10
+BATCH_GET_ITEM_MAX_KEYS = 100
+BATCH_GET_ITEM_MAX_RETRIES = 8
+
+# Assumed role credentials are refreshed when they expire in less than this
+CREDENTIALS_REFRESH_MARGIN = timedelta(minutes=5)
+
+
+class CredentialCache:
     """
-    try:
-        # find account ID by key
-        account_id = next(
-            (account['id'] for account in account_list if account['key'] == account_key), None)
+    Thread-safe cache of assumed role credentials keyed by account
 
-        if account_id is None:
-            raise ValueError(f'Account ID not found for key: {account_key}')
+    The role is assumed once per account and the credentials are shared by all
+    the regions of the account. They are refreshed shortly before they expire.
+    """
 
-        sts_client = boto3.client('sts')
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._account_locks = {}
+        self._credentials = {}
+
+    def get(self, account_id, assume_role):
+        """
+        Returns valid credentials for the role in the account
+
+        Args:
+            account_id: AWS account id
+            assume_role: name of role to assume
+
+        Returns:
+            dict: Credentials of the assume_role response
+        """
+        with self._lock:
+            account_lock = self._account_locks.setdefault(account_id, threading.Lock())
+
+        # only one thread assumes the role of an account, the others wait for it
+        with account_lock:
+            with self._lock:
+                credentials = self._credentials.get(account_id)
+            if credentials is None or \
+                    credentials['Expiration'] - datetime.now(timezone.utc) < CREDENTIALS_REFRESH_MARGIN:
+                credentials = self._assume_role(account_id, assume_role)
+                with self._lock:
+                    self._credentials[account_id] = credentials
+            return credentials
+
+    @staticmethod
+    def _assume_role(account_id, assume_role):
+        with client_lock:
+            sts_client = boto3.client('sts')
         role_arn = f"arn:aws:iam::{account_id}:role/{assume_role}"
 
         try:
@@ -39,13 +84,34 @@ def get_ec2_client(account_key, account_list, assume_role, region):
         except sts_client.exceptions.ClientError as e:
             logger.error(f"Failed to assume role {role_arn}: {str(e)}")
             raise
+        return response['Credentials']
+
+
+credential_cache = CredentialCache()
+
+
+def get_ec2_client(account_key, account_directory, assume_role, region):
+    """
+    Returns an EC2 client with appropriate credentials for account
+    account_key: account key from ASEA config
+    account_directory: account configurations by account key, from build_account_directory
+    assume_role: name of role to assume
+    region: AWS region to connect to
+    """
+    try:
+        # find account ID by key
+        account = account_directory.get(account_key)
 
-        session = boto3.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken'])
+        if account is None:
+            raise ValueError(f'Account ID not found for key: {account_key}')
 
-        return session.client("ec2", region_name=region)
+        credentials = credential_cache.get(account['id'], assume_role)
+        with client_lock:
+            return ec2_session.client(
+                "ec2", region_name=region,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'])
     except Exception as e:
         logger.error(f"Error creating EC2 client: {str(e)}")
         raise
@@ -67,18 +133,27 @@ def get_accounts_config(parameter_table_name, region="ca-central-1"):
         ValueError: If parameters not found in table
     """
     try:
-        client = boto3.client('dynamodb', region_name=region)
-        accounts = []
-
-        index = 0
+        with client_lock:
+            client = boto3.client('dynamodb', region_name=region)
+
+        # The account list is split in accounts/0, accounts/1, ... chunks, the
+        # chunks are requested in windows of keys that grow until a key is missing
+        chunks = {}
+        start = 0
+        window = ACCOUNTS_KEY_WINDOW
         while True:
-            response = client.get_item(
-                TableName=parameter_table_name,
-                Key={'id': {'S': f"accounts/{index}"}}
-            )
-            if 'Item' not in response:
+            keys = [f"accounts/{index}" for index in range(start, start + window)]
+            chunks.update(batch_get_parameters(client, parameter_table_name, keys))
+            if any(key not in chunks for key in keys):
                 break
-            accounts.extend(json.loads(response['Item']['value']['S']))
+            start += window
+            window = min(window * 2, BATCH_GET_ITEM_MAX_KEYS)
+
+        # Keep the chunks up to the first missing one, like reading them one by one
+        accounts = []
+        index = 0
+        while f"accounts/{index}" in chunks:
+            accounts.extend(json.loads(chunks[f"accounts/{index}"]))
             index += 1
 
         return accounts
@@ -93,6 +168,95 @@ def get_accounts_config(parameter_table_name, region="ca-central-1"):
         raise
 
 
+def batch_get_parameters(client, parameter_table_name, keys):
+    """
+    Get parameters from the DynamoDB parameter table with BatchGetItem
+
+    Args:
+        client: DynamoDB client
+        parameter_table_name: Name of the DynamoDB parameter table
+        keys: parameter ids to get, at most 100
+
+    Returns:
+        dict: value of the parameters found in the table, by parameter id
+
+    Raises:
+        ClientError: If AWS API call fails
+        RuntimeError: If some keys are still unprocessed after all the retries
+    """
+    values = {}
+    request_items = {
+        parameter_table_name: {'Keys': [{'id': {'S': key}} for key in keys]}
+    }
+    for attempt in range(BATCH_GET_ITEM_MAX_RETRIES):
+        response = client.batch_get_item(RequestItems=request_items)
+        for item in response['Responses'].get(parameter_table_name, []):
+            values[item['id']['S']] = item['value']['S']
+
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            return values
+        # DynamoDB returns unprocessed keys when the table is throttled, back off before retrying them
+        time.sleep(min(0.05 * 2 ** attempt, 5))
+
+    raise RuntimeError(
+        f"Keys still unprocessed after {BATCH_GET_ITEM_MAX_RETRIES} attempts on {parameter_table_name}")
+
+
+def load_accounts_config(parameter_table_name, region, cache_dir, refresh=False):
+    """
+    Get accounts configuration from the local cache or from the DynamoDB parameter table
+
+    Args:
+        parameter_table_name: Name of the DynamoDB parameter table
+        region: AWS region where the table exists
+        cache_dir: directory of the accounts cache files
+        refresh: read the table even if the accounts are in the cache
+
+    Returns:
+        list: List of account configurations
+    """
+    # the cache is keyed by the management account too, different ASEA environments
+    # checked from the same directory use the same table name and region
+    with client_lock:
+        sts_client = boto3.client('sts')
+    caller_account_id = sts_client.get_caller_identity()['Account']
+    cache_path = os.path.join(
+        cache_dir, f"{caller_account_id}-{parameter_table_name}-{region}-accounts.json")
+
+    if not refresh and os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if isinstance(cached, dict) and cached.get("CallerAccountId") == caller_account_id:
+            logger.info(f"Using accounts config cached in {cache_path}")
+            return cached["Accounts"]
+        logger.warning(f"Ignoring accounts config cached in {cache_path} for another account")
+
+    accounts = get_accounts_config(parameter_table_name, region)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first so an interrupted run doesn't leave a truncated cache
+    with open(f"{cache_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"CallerAccountId": caller_account_id, "Accounts": accounts}, f, indent=2)
+    os.replace(f"{cache_path}.tmp", cache_path)
+
+    return accounts
+
+
+def build_account_directory(accounts) -> Mapping[str, Dict]:
+    """
+    Index the accounts configuration by account key
+
+    Args:
+        accounts: list of account configurations from load_accounts_config
+
+    Returns:
+        Mapping: read-only mapping of account key to account configuration, shared by all regions
+    """
+    return MappingProxyType({account['key']: account for account in accounts})
+
+
 def get_vpcs_from_config(aseaConfig, region):
     """
     Returns a dictionary of accounts with their respective VPCs for the provided region
@@ -151,10 +315,11 @@ def flatten_subnet_config(vpc_name, subnets):
 
 def get_account_vpcs(ec2_client):
     """Returns dict of VPCs in account. key: Name, Value: VpcId"""
-    response = ec2_client.describe_vpcs()
+    paginator = ec2_client.get_paginator('describe_vpcs')
     return {
         next((tag["Value"] for tag in vpc["Tags"] if tag["Key"] == "Name"), ""): vpc["VpcId"]
-        for vpc in response["Vpcs"]
+        for page in paginator.paginate()
+        for vpc in page["Vpcs"]
     }
 
 
@@ -359,18 +524,16 @@ def get_transit_gateway_routes(ec2_client, tgwrt_id: str, state: str) -> List[Di
         raise
 
 
-def get_vpc_route_tables(ec2_client, vpcId):
+def get_account_route_tables(ec2_client):
     """
-    Returns all route tables of a VPC
-    ec2_client: EC2 client with credentials for the account of the VPC
-    vpcId: id of VPC to get route tables
+    Returns all route tables of the account grouped by VPC. key: VpcId, Value: list of route tables
+    ec2_client: EC2 client with credentials for the account
     """
 
-    response = ec2_client.describe_route_tables(
-        Filters=[{"Name": "vpc-id", "Values": [vpcId]}])
-    rt_list = []
+    paginator = ec2_client.get_paginator('describe_route_tables')
+    rt_by_vpc = {}
 
-    for rt in response["RouteTables"]:
+    for rt in (rt for page in paginator.paginate() for rt in page["RouteTables"]):
         name = next((tag["Value"] for tag in rt["Tags"]
                     if tag["Key"] == "Name"), rt["RouteTableId"])
         r = {"Name": name,
@@ -382,23 +545,21 @@ def get_vpc_route_tables(ec2_client, vpcId):
              "RawResponse": rt
              }
 
-        rt_list.append(r)
+        rt_by_vpc.setdefault(rt["VpcId"], []).append(r)
 
-    return rt_list
+    return rt_by_vpc
 
 
-def get_vpc_subnets(ec2_client, vpcId):
+def get_account_subnets(ec2_client):
     """
-    Returns all subnets of a VPC
-    ec2_client: EC2 client with credentials for the account of the VPC
-    vpcId: id of VPC to get subnets
+    Returns all subnets of the account grouped by VPC. key: VpcId, Value: list of subnets
+    ec2_client: EC2 client with credentials for the account
     """
 
-    response = ec2_client.describe_subnets(
-        Filters=[{"Name": "vpc-id", "Values": [vpcId]}])
-    subnet_list = []
+    paginator = ec2_client.get_paginator('describe_subnets')
+    subnets_by_vpc = {}
 
-    for subnet in response["Subnets"]:
+    for subnet in (subnet for page in paginator.paginate() for subnet in page["Subnets"]):
         name = next((tag["Value"] for tag in subnet["Tags"]
                     if tag["Key"] == "Name"), subnet["SubnetId"])
         s = {"Name": name,
@@ -407,9 +568,9 @@ def get_vpc_subnets(ec2_client, vpcId):
              "AvailabilityZone": subnet["AvailabilityZone"],
              "RawResponse": subnet
              }
-        subnet_list.append(s)
+        subnets_by_vpc.setdefault(subnet["VpcId"], []).append(s)
 
-    return subnet_list
+    return subnets_by_vpc
 
 
 def map_subnets_to_route_table(subnets, route_tables):
@@ -435,10 +596,68 @@ def map_subnets_to_route_table(subnets, route_tables):
     return list
 
 
-def analyze_vpcs(vpc_from_config, account_list, role_to_assume, region):
+def collect_account_inventory(account, vpc_names, account_directory, role_to_assume, region):
+    """
+    Collect the VPCs deployed in an account with the route tables and subnets of the VPCs defined in the config
+
+    Args:
+        account: account key from ASEA config
+        vpc_names: names of the VPCs defined in the config for the account
+        account_directory: account configurations by account key
+        role_to_assume: name of role to assume
+        region: AWS region to inventory
+
+    Returns:
+        dict: deployed VPCs by name with their VpcId, and their RouteTables and Subnets if they are in vpc_names
+    """
+    logger.info(f"Collecting VPC inventory of account {account} in {region}")
+    client = get_ec2_client(account, account_directory, role_to_assume, region)
+
+    # Route tables and subnets are described once for the whole account and grouped by VPC
+    vpcs = get_account_vpcs(client)
+    route_tables = get_account_route_tables(client) if vpcs else {}
+    subnets = get_account_subnets(client) if vpcs else {}
+
+    inventory = {}
+    for name, vpc_id in vpcs.items():
+        vpc = {"VpcId": vpc_id}
+        if name in vpc_names:
+            vpc["RouteTables"] = route_tables.get(vpc_id, [])
+            vpc["Subnets"] = subnets.get(vpc_id, [])
+        inventory[name] = vpc
+
+    return inventory
+
+
+def collect_vpc_inventory(vpc_from_config, account_directory, role_to_assume, region, max_workers):
+    """
+    Collect the VPC inventory of all accounts with VPCs in the config in parallel
+
+    Args:
+        vpc_from_config: accounts with their respective VPCs from get_vpcs_from_config
+        account_directory: account configurations by account key
+        role_to_assume: name of role to assume
+        region: AWS region to inventory
+        max_workers: maximum number of accounts inventoried in parallel
+
+    Returns:
+        dict: inventory of each account from collect_account_inventory, in the order of vpc_from_config
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            account: executor.submit(collect_account_inventory, account,
+                                     {f"{vpc['Name']}_vpc" for vpc in vpcs},
+                                     account_directory, role_to_assume, region)
+            for account, vpcs in vpc_from_config.items()
+        }
+        return {account: future.result() for account, future in futures.items()}
+
+
+def analyze_vpcs(vpc_from_config, account_directory, role_to_assume, region, max_workers=10):
     """
     Find all VPCs defined in the config with their route tables and subnets
     Works only in a single region. Need to be updated to describe VPC in all regions where VPC are configured
+    The inventory of all accounts is collected in parallel before being compared with the config
     """
 
     drift = {
@@ -453,9 +672,11 @@ def analyze_vpcs(vpc_from_config, account_list, role_to_assume, region):
     }
     vpc_details = {}
 
+    inventory = collect_vpc_inventory(
+        vpc_from_config, account_directory, role_to_assume, region, max_workers)
+
     for account in vpc_from_config.keys():
-        client = get_ec2_client(account, account_list, role_to_assume, region)
-        deployed_vpcs = get_account_vpcs(client)
+        deployed_vpcs = inventory[account]
 
         # check if there are more VPCs than in the config
         for dv in deployed_vpcs.keys():
@@ -471,7 +692,7 @@ def analyze_vpcs(vpc_from_config, account_list, role_to_assume, region):
             logger.info(f"VPC {dv} in account {account} found in config")
 
             # check if there are more route table than in the config
-            d_rtables = get_vpc_route_tables(client, deployed_vpcs[dv])
+            d_rtables = deployed_vpcs[dv]["RouteTables"]
             for drt in d_rtables:
                 crt = [rt for rt in cv[0]["RouteTables"]
                        if f"{rt['name']}_rt" == drt["Name"]]
@@ -508,7 +729,7 @@ def analyze_vpcs(vpc_from_config, account_list, role_to_assume, region):
                             {"RouteTable": crt['name'], "Vpc": dv, "Entries": rteDrift})
 
             # check if there are more subnets than in the config
-            d_subnets = get_vpc_subnets(client, deployed_vpcs[dv])
+            d_subnets = deployed_vpcs[dv]["Subnets"]
             for ds in d_subnets:
                 cs = [s for s in cv[0]["Subnets"] if s['Name'] == ds["Name"]]
                 if len(cs) == 0:
@@ -785,6 +1006,72 @@ def get_unique_regions(config):
     return list(regions)
 
 
+def analyze_region(config, region, account_directory, role_to_assume, output_path, max_workers):
+    """
+    Compare the VPC and Transit Gateway config of a region with the environment and write the region output files
+
+    Args:
+        config: ASEA config
+        region: AWS region to analyze
+        account_directory: account configurations by account key
+        role_to_assume: name of role to assume
+        output_path: output directory, the files are written in a sub-directory named after the region
+        max_workers: maximum number of accounts inventoried in parallel
+
+    Returns:
+        dict: SubnetDrift and TgwDrift of the region
+    """
+    logger.info(f"Processing region: {region}")
+    shared_network_key = 'shared-network'
+
+    # Create region-specific output directory
+    region_output_path = os.path.join(output_path, region)
+    if not os.path.exists(region_output_path):
+        os.makedirs(region_output_path)
+
+    # Get VPC config for the specific region
+    vpc_config = get_vpcs_from_config(config, region)
+
+    with open(os.path.join(region_output_path, "vpc_config.json"), "w", encoding="utf-8") as f:
+        json.dump(vpc_config, f, indent=2,
+                  default=datetime_serializer, sort_keys=True)
+
+    # Compare VPC config with environment for the region
+    vpc_result = analyze_vpcs(
+        vpc_config, account_directory, role_to_assume, region, max_workers)
+
+    with open(os.path.join(region_output_path, "vpc_inventory.json"), "w", encoding="utf-8") as f:
+        json.dump(vpc_result["VpcDetails"], f, indent=2, sort_keys=True)
+
+    # Compare Transit Gateway config for the region
+    network_account = get_ec2_client(
+        shared_network_key, account_directory, role_to_assume, region)
+
+    tgw_config = get_tgw_from_config(config, region)
+    tgw_deployed = get_transit_gateway(network_account)
+    tgw_result = analyze_tgw(tgw_config, tgw_deployed, vpc_config)
+
+    with open(os.path.join(region_output_path, "tgw_config.json"), "w", encoding="utf-8") as f:
+        json.dump(tgw_config, f, indent=2,
+                  default=datetime_serializer, sort_keys=True)
+
+    with open(os.path.join(region_output_path, "tgw_inventory.json"), "w", encoding="utf-8") as f:
+        json.dump(tgw_deployed, f, indent=2,
+                  default=datetime_serializer, sort_keys=True)
+
+    # Store region results
+    drift = {
+        "SubnetDrift": vpc_result["Drift"],
+        "TgwDrift": tgw_result
+    }
+
+    with open(os.path.join(region_output_path, "drift.json"), "w", encoding="utf-8") as f:
+        json.dump(drift, f, indent=2,
+                  default=datetime_serializer, sort_keys=True)
+
+    return drift
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='lza-upgrade-check',
@@ -801,6 +1088,12 @@ def main():
                         help="Output directory")
     parser.add_argument('--home-region', default='ca-central-1',
                         help="AWS Home Region")
+    parser.add_argument('--max-workers', type=int, default=10,
+                        help="Maximum number of accounts inventoried in parallel in each region")
+    parser.add_argument('--cache-dir', default='cache',
+                        help="Directory where the accounts config read from the parameter table is cached")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Read the accounts config from the parameter table even if it is cached")
 
     args = parser.parse_args()
 
@@ -809,7 +1102,6 @@ def main():
     output_path = args.output_dir
     role_to_assume = args.role_to_assume if args.role_to_assume else f"{accel_prefix}-PipelineRole"  # nopep8
     parameter_table = f"{accel_prefix}-Parameters"
-    shared_network_key = 'shared-network'
     home_region = args.home_region
 
     # Load ASEA config
@@ -824,63 +1116,20 @@ def main():
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    # Initialize consolidated results
-    consolidated_results = {
-        "regions": {}
-    }
-
-    # Process each region
-    for region in regions:
-        logger.info(f"Processing region: {region}")
-
-        # Create region-specific output directory
-        region_output_path = os.path.join(output_path, region)
-        if not os.path.exists(region_output_path):
-            os.makedirs(region_output_path)
-
-        # Get accounts config from home region
-        accounts = get_accounts_config(parameter_table, home_region)
-
-        # Get VPC config for the specific region
-        vpc_config = get_vpcs_from_config(config, region)
-
-        with open(os.path.join(region_output_path, "vpc_config.json"), "w", encoding="utf-8") as f:
-            json.dump(vpc_config, f, indent=2,
-                      default=datetime_serializer, sort_keys=True)
-
-        # Compare VPC config with environment for the region
-        vpc_result = analyze_vpcs(vpc_config, accounts, role_to_assume, region)
+    # Get accounts config from home region once, it is shared by all regions
+    account_directory = build_account_directory(
+        load_accounts_config(parameter_table, home_region, args.cache_dir, args.refresh))
 
-        with open(os.path.join(region_output_path, "vpc_inventory.json"), "w", encoding="utf-8") as f:
-            json.dump(vpc_result["VpcDetails"], f, indent=2, sort_keys=True)
-
-        # Compare Transit Gateway config for the region
-        network_account = get_ec2_client(
-            shared_network_key, accounts, role_to_assume, region)
-
-        tgw_config = get_tgw_from_config(config, region)
-        tgw_deployed = get_transit_gateway(network_account)
-        tgw_result = analyze_tgw(tgw_config, tgw_deployed, vpc_config)
-
-        with open(os.path.join(region_output_path, "tgw_config.json"), "w", encoding="utf-8") as f:
-            json.dump(tgw_config, f, indent=2,
-                      default=datetime_serializer, sort_keys=True)
-
-        with open(os.path.join(region_output_path, "tgw_inventory.json"), "w", encoding="utf-8") as f:
-            json.dump(tgw_deployed, f, indent=2,
-                      default=datetime_serializer, sort_keys=True)
-
-        # Store region results
-        drift = {
-            "SubnetDrift": vpc_result["Drift"],
-            "TgwDrift": tgw_result
+    # Process all regions concurrently
+    with ThreadPoolExecutor(max_workers=max(len(regions), 1)) as executor:
+        futures = {
+            region: executor.submit(analyze_region, config, region, account_directory,
+                                    role_to_assume, output_path, args.max_workers)
+            for region in regions
+        }
+        consolidated_results = {
+            "regions": {region: future.result() for region, future in futures.items()}
         }
-
-        with open(os.path.join(region_output_path, "drift.json"), "w", encoding="utf-8") as f:
-            json.dump(drift, f, indent=2,
-                      default=datetime_serializer, sort_keys=True)
-
-        consolidated_results["regions"][region] = drift
 
     # Write consolidated results
     with open(os.path.join(output_path, "consolidated_drift.json"), "w", encoding="utf-8") as f: